@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+
+'''
+    Receives the attendance pushed by devices over HTTP (the ZKTeco ADMS / iclock protocol)
+    and stores it in the same records collection as puller.py, so devices behind NAT
+    can be ingested without being polled.
+
+    Point the "Cloud Server" / ADMS settings of the devices to this host and port.
+'''
+
+import signal
+import threading
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+from bio_config import devices, adms
+from db import db
+from logger import logger
+
+
+def parse_attlog(body: str, device: str) -> tuple:
+    """
+    Parses an ATTLOG push into attendance records.
+    Each line holds tab-separated fields: PIN, time, punch state, verify mode, work code, ...
+
+    :param body: The body of the push
+    :param device: The device the records belong to
+    :return: A tuple (records, skipped) with the parsed records and the number of unreadable lines
+    """
+    records, skipped = [], 0
+    for line in body.splitlines():
+        fields = line.strip().split('\t')
+        if len(fields) < 2 or not fields[0]:
+            skipped += bool(line.strip())
+            continue
+
+        try:
+            records.append({
+                "attendance_device_id": fields[0].strip(),
+                "timestamp": datetime.strptime(fields[1].strip(), '%Y-%m-%d %H:%M:%S'),
+                "status": int(fields[3]) if len(fields) > 3 and fields[3].strip().isdigit() else 0,
+                "punch": int(fields[2]) if len(fields) > 2 and fields[2].strip().isdigit() else 0,
+                "device": device,
+            })
+        except ValueError:
+            skipped += 1
+
+    return records, skipped
+
+
+class ADMSHandler(BaseHTTPRequestHandler):
+    """
+    Handles the requests of the iclock protocol. Only attendance logs are stored,
+    every other table is acknowledged and dropped.
+    """
+    server_version = "iclock"
+    serials = {}  # Serial number -> device configuration, from bio_config.devices
+
+    def reply(self, code: int, text: str):
+        body = text.encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def device(self, query: dict) -> tuple:
+        """
+        Identifies the device of a request by its serial number.
+
+        :param query: The parsed query string
+        :return: A tuple (serial number, device key), the key is None if the device is not allowed
+        """
+        sn = (query.get('SN') or [''])[0]
+        if not sn:
+            return sn, None
+
+        if sn in self.serials:
+            return sn, self.serials[sn].get('ip', sn)
+
+        return sn, None if adms.get('known_only', True) else sn
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        sn, device = self.device(parse_qs(url.query))
+        if device is None:
+            return self.reply(403, "Unknown device")
+
+        if url.path == '/iclock/cdata':  # Handshake, tells the device what to push
+            return self.reply(200, "\n".join([
+                f"GET OPTION FROM: {sn}",
+                "ATTLOGStamp=None",
+                "OPERLOGStamp=9999",
+                "ATTPHOTOStamp=None",
+                f"ErrorDelay={adms.get('error_delay', 30)}",
+                f"Delay={adms.get('delay', 10)}",
+                "TransTimes=00:00;14:05",
+                "TransInterval=1",
+                "TransFlag=TransData AttLog",
+                "Realtime=1",
+                "Encrypt=None",
+            ]))
+
+        if url.path == '/iclock/getrequest':  # The device polls for commands, there are none
+            return self.reply(200, "OK")
+
+        return self.reply(404, "Not found")
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        sn, device = self.device(query)
+        if device is None:
+            return self.reply(403, "Unknown device")
+
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0)).decode('utf-8', errors='replace')
+        if url.path != '/iclock/cdata' or (query.get('table') or [''])[0] != 'ATTLOG':
+            return self.reply(200, "OK")
+
+        records, skipped = parse_attlog(body, device)
+        if skipped:
+            logger.warning(f"Skipped {skipped} unreadable lines pushed by device {sn}")
+
+        if records:
+            re = db.upsert_records(records)
+            if re is None:  # Not acknowledged, so the device pushes the records again later
+                logger.error(f"Failed to store the records pushed by device {sn}")
+                return self.reply(503, "ERROR")
+
+            logger.success(f"Inserted {re['inserted']} new records ({re['existing']} already stored) pushed by device {sn}")
+
+        return self.reply(200, f"OK: {len(records)}")
+
+    def log_message(self, format, *args):
+        logger.debug(f"{self.address_string()} - {format % args}")
+
+
+def create_server(host='0.0.0.0', port=8081) -> ThreadingHTTPServer:
+    """
+    Creates the receiver, handling every connected device in its own thread.
+
+    :param host: The address to listen on
+    :param port: The port to listen on
+    :return: The server, call serve_forever() on it
+    """
+    ADMSHandler.serials = { d['serial_number']: d for d in devices if d.get('serial_number') }
+    server = ThreadingHTTPServer((host, port), ADMSHandler)
+    server.daemon_threads = True
+    return server
+
+
+if __name__ == "__main__":
+    server = create_server(adms.get('host', '0.0.0.0'), adms.get('port', 8081))
+    stop = lambda signum, frame: threading.Thread(target=server.shutdown).start()
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    logger.info(f"ADMS receiver listening on {server.server_address[0]}:{server.server_address[1]}")
+    server.serve_forever()
+    server.server_close()
+    db.close_connection()
@@ -0,0 +1,51 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+
+class SkippedError(Exception):
+    """Exception recorded for a record that was not processed because an earlier record of the same key failed."""
+    def __init__(self, message="Skipped because an earlier record of the same employee failed."):
+        self.message = message
+        super().__init__(self.message)
+
+
+async def run_ordered(records: list, handler, key, concurrency: int=8) -> list:
+    """
+    Runs a blocking handler for every record with bounded concurrency.
+    Records that share a key are handled one after the other in their original order,
+    records with different keys are handled in parallel. Once a record fails, the
+    remaining records of its key are skipped so they are not decided on a wrong state.
+
+    :param records: The records to handle
+    :param handler: A blocking function taking one record
+    :param key: A function returning the ordering key of a record (e.g. its employee)
+    :param concurrency: The maximum number of records handled at the same time
+    :return: A list with, for each record, the handler's result or the exception it raised
+    """
+    loop = asyncio.get_running_loop()
+    executor = ThreadPoolExecutor(max_workers=max(1, concurrency))
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+    results = [None] * len(records)
+
+    groups = {}
+    for i, record in enumerate(records):
+        groups.setdefault(key(record), []).append(i)
+
+    async def run_group(positions):
+        for n, i in enumerate(positions):
+            async with semaphore:
+                try:
+                    results[i] = await loop.run_in_executor(executor, handler, records[i])
+                except Exception as e:
+                    results[i] = e
+                    for j in positions[n + 1:]:
+                        results[j] = SkippedError()
+                    return
+
+    try:
+        await asyncio.gather(*(run_group(positions) for positions in groups.values()))
+    finally:
+        executor.shutdown(wait=False)
+
+    return results
+
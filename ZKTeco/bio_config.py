@@ -1,6 +1,8 @@
 # The configuration file for the ZKTeco API and Frappe API
 # Please fill in the necessary details before running the Attendance script
 # Devices
+# Devices that push their attendance to adms.py get their "serial_number" and "push": True,
+# so that the puller leaves them alone.
 devices = [
   {
     "name": "Device 1",
@@ -8,3 +10,93 @@ devices = [
   }
 ]
 
+# Database
+database = {
+  "uri": "mongodb://localhost:27017/", # MongoDB connection string
+  "name": "attendance", # Database holding the records, the ERP state and the outbox
+}
+
+# Puller
+puller = {
+  "workers": 8, # How many devices are pulled at the same time
+  "deadline": 60, # Seconds a single device may take before it is abandoned (can be overridden per device)
+  "incremental": False, # Keep device logs and only store records newer than the last pull (clear them with `puller.py --clear`)
+  "chunk_size": 5000, # Records converted and written to the database at a time
+  "grace": 30, # Seconds puller.py waits for devices past their deadline to finish storing before it exits
+}
+
+# Sync (main.py)
+sync = {
+  "concurrency": 8, # Records decided and submitted at the same time with --async (keep the http pool_size at least this big)
+}
+
+# Check-in state (last punch of each employee, kept locally)
+state = {
+  "reconcile_interval": 3600, # Seconds between reconciliations of the local state with the ERP
+}
+
+# Importer (main.py --import)
+importer = {
+  "batch_size": 500, # Records read from the database and sent to the ERP at a time
+  "pause": 0, # Seconds to wait between batches, to go easy on the ERP
+}
+
+# HTTP (ERP transports)
+http = {
+  "pool_size": 10, # Keep-alive connections per ERP host, should be at least the number of concurrent workers
+  "retries": 3, # Retries of idempotent (GET) requests on connection errors and 429/502/503/504 responses
+  "backoff": 0.5, # Base seconds of the exponential backoff between retries (a random jitter is added)
+  "timeout": 30, # Seconds before a request is abandoned
+}
+
+# Employee directory (local copy of the ERP employee list)
+directory = {
+  "ttl": 3600, # Seconds before the directory is refreshed from the ERP
+}
+
+# Outbox (submissions waiting to be sent to the ERP)
+outbox = {
+  "max_attempts": 8, # Failed sends before a submission is parked as dead (status 'dead' in the outbox collection)
+  "backoff": 30, # Base seconds of the exponential backoff between attempts (a random jitter is applied)
+  "max_backoff": 3600, # Longest wait between two attempts, in seconds
+  "max_failures": 5, # Consecutive failed sends after which a drain stops (the ERP is probably down)
+  "drain_budget": 300, # Seconds a single drain may spend sending before it stops
+}
+
+# Service (service.py, a long-running replacement for the cron job)
+service = {
+  "pull_interval": 600, # Seconds between two pulls of the devices
+  "sync_interval": 600, # Seconds between two syncs with the ERP
+  "catchup_after": 1200, # Seconds without a successful sync after which the backlog is sent in batches through the bulk endpoint
+  "bulk": True, # Use the bulk endpoint of the ERP for regular syncs too
+}
+
+# Live capture (punches are stored as they happen instead of on the next pull)
+live = {
+  "enabled": False, # Hold a live subscription per device in service.py (or run live.py on its own)
+  "timeout": 10, # Seconds to wait for a punch before checking whether the subscription should stop
+  "idle": 300, # Seconds without a punch after which the subscription is renewed, to detect dead connections
+  "backoff": 5, # Base seconds between reconnection attempts, doubled after each failure
+  "max_backoff": 300, # Longest wait between reconnection attempts, in seconds
+}
+
+# ADMS receiver (adms.py, for devices pushing their attendance over HTTP)
+adms = {
+  "host": "0.0.0.0", # Address to listen on
+  "port": 8081, # Port to listen on, set as the server port in the "Cloud Server" settings of the devices
+  "known_only": True, # Only accept devices whose serial_number is listed in `devices` (False accepts any device that can reach the port)
+  "delay": 10, # Seconds between two pushes of a device
+  "error_delay": 30, # Seconds a device waits before pushing again after an error
+}
+
+# Metrics (stage timings and counters, see metrics.py)
+metrics = {
+  "exporter": None, # None, "textfile" (Prometheus node_exporter textfile collector) or "mongo" (the `metrics` collection)
+  "textfile_dir": "/var/lib/prometheus/node-exporter", # Directory of the .prom files, one per process (puller, main, service)
+}
+
+# Profiling (main.py and puller.py with --profile and/or --trace-memory, see profiling.py)
+profiling = {
+  "directory": "profiles", # Directory of the profiled runs, one sub-directory per run
+  "keep": 10, # Number of runs kept, the oldest are deleted
+}
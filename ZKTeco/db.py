@@ -1,4 +1,7 @@
 import pymongo
+import threading
+from datetime import datetime
+from bio_config import database
 from logger import logger
 
 class DB:
@@ -10,6 +13,10 @@ class DB:
         Initialize the DB class.
         """
         self.client = None
+        self.indexed = False
+        self.lock = threading.RLock()
+        self.uri = database.get('uri', 'mongodb://localhost:27017/')
+        self.name = database.get('name', 'attendance')
 
     def connect(self):
         """
@@ -20,7 +27,7 @@ class DB:
             return self.client
 
         try:
-            client = pymongo.MongoClient("mongodb://localhost:27017/")
+            client = pymongo.MongoClient(self.uri)
             return client
         except pymongo.errors.ConnectionError as e:
             logger.error(f"Could not connect to MongoDB: {e}")
@@ -35,11 +42,191 @@ class DB:
         """
 
         if self.client:
-            db = self.client.attendance
+            db = self.client[self.name]
             return db[collection_name]
-        else:
-            self.client = self.connect()
-            return self.client.attendance[collection_name] if self.client else None
+
+        with self.lock:  # Threads (live captures, ADMS handlers) must not each create a client
+            if self.client is None:
+                self.client = self.connect()
+                if self.client and not self.indexed:
+                    self.ensure_indexes()
+            return self.client[self.name][collection_name] if self.client else None
+
+    def ensure_indexes(self):
+        """
+        Create the indexes the records collection relies on.
+        The unique index makes ingestion idempotent, the second one serves the
+        latest-record aggregation without a collection scan and in-memory sort.
+        The `latest` rollup is built from the stored records the first time.
+
+        :return: None
+        """
+        records = self.client[self.name]['records']
+        try:
+            try:
+                records.create_index(
+                    [("device", 1), ("attendance_device_id", 1), ("timestamp", 1)],
+                    unique=True, name="device_employee_timestamp"
+                )
+            except pymongo.errors.DuplicateKeyError:
+                logger.warning("Duplicate attendance records found. Removing them before creating the unique index...")
+                self.remove_duplicate_records()
+                records.create_index(
+                    [("device", 1), ("attendance_device_id", 1), ("timestamp", 1)],
+                    unique=True, name="device_employee_timestamp"
+                )
+
+            records.create_index([("attendance_device_id", 1), ("timestamp", -1)], name="employee_latest")
+
+            # Records stored before the delivery ledger existed were handled by earlier runs.
+            # A one-time migration: it runs until the index below exists, not on every start
+            if "undelivered" not in records.index_information():
+                records.update_many({ "delivered": { "$exists": False } }, { "$set": { "delivered": True } })
+            records.create_index(
+                [("timestamp", 1)],
+                partialFilterExpression={ "delivered": False }, name="undelivered"
+            )
+            self.client[self.name]['employees'].create_index(
+                [("source", 1), ("employee", 1)], unique=True, name="source_employee"
+            )
+            self.client[self.name]['checkin_state'].create_index(
+                [("erp", 1), ("employee", 1)], unique=True, name="erp_employee"
+            )
+            self.client[self.name]['outbox'].create_index(
+                [("erp", 1), ("status", 1), ("next_attempt_at", 1)], name="due"
+            )
+            if self.client[self.name]['latest'].estimated_document_count() == 0 and records.find_one({}, { "_id": 1 }):
+                self.rebuild_latest()
+            self.indexed = True
+
+        except pymongo.errors.PyMongoError as e:
+            logger.error(f"Error creating indexes: {e}")
+
+    def remove_duplicate_records(self):
+        """
+        Remove duplicate attendance records, keeping the first copy of each punch.
+
+        :return: The number of removed records.
+        """
+        records = self.client[self.name]['records']
+        pipeline = [
+            {
+                "$group": {
+                    "_id": { "device": "$device", "attendance_device_id": "$attendance_device_id", "timestamp": "$timestamp" },
+                    "ids": { "$push": "$_id" },
+                    "count": { "$sum": 1 }
+                }
+            },
+            { "$match": { "count": { "$gt": 1 } } }
+        ]
+        removed = 0
+        for group in records.aggregate(pipeline, allowDiskUse=True):
+            removed += records.delete_many({ "_id": { "$in": group["ids"][1:] } }).deleted_count
+
+        logger.info(f"Removed {removed} duplicate attendance records.")
+        return removed
+
+    def upsert_records(self, records):
+        """
+        Write attendance records idempotently: a punch that is already stored
+        (same device, employee and timestamp) is left untouched.
+
+        :param records: A list of attendance records.
+        :return: A dictionary with the `inserted` and `existing` counts, or None if the write failed.
+        """
+        client = self.get_db('records')
+        if client is None:
+            logger.error("Database connection failed. Cannot store records.")
+            return None
+
+        if not records:
+            return {"inserted": 0, "existing": 0}
+
+        ops = [
+            pymongo.UpdateOne(
+                { "device": r.get("device"), "attendance_device_id": r.get("attendance_device_id"), "timestamp": r.get("timestamp") },
+                { "$setOnInsert": { **r, "delivered": False } },
+                upsert=True
+            )
+            for r in records
+        ]
+        try:
+            result = client.bulk_write(ops, ordered=False)
+            self.update_latest([{ **records[i], "_id": _id, "delivered": False } for i, _id in result.upserted_ids.items()])
+            return {"inserted": result.upserted_count, "existing": result.matched_count}
+
+        except pymongo.errors.BulkWriteError as e:
+            details = e.details or {}
+            errors = details.get("writeErrors", [])
+            duplicates = [err for err in errors if err.get("code") == 11000]  # A concurrent writer stored the same punch first
+            if len(duplicates) < len(errors):
+                logger.error(f"Error storing records: {[err.get('errmsg') for err in errors if err.get('code') != 11000]}")
+                return None
+
+            self.update_latest([{ **records[u["index"]], "_id": u["_id"], "delivered": False } for u in details.get("upserted", [])])
+            return {"inserted": details.get("nUpserted", 0), "existing": details.get("nMatched", 0) + len(duplicates)}
+
+        except pymongo.errors.PyMongoError as e:
+            logger.error(f"Error storing records: {e}")
+            return None
+
+    def update_latest(self, records):
+        """
+        Roll stored records up into the `latest` collection, which holds the newest record
+        of every employee. An entry is only replaced by a newer record: when the stored one is
+        as new or newer the filter does not match, the upsert collides on `_id` and is ignored.
+
+        :param records: A list of stored attendance records, with their `_id`.
+        :return: None
+        """
+        newest = {}
+        for r in records:
+            current = newest.get(r.get("attendance_device_id"))
+            if current is None or r.get("timestamp") > current.get("timestamp"):
+                newest[r.get("attendance_device_id")] = r
+
+        client = self.get_db('latest')
+        if not newest or client is None:
+            return
+
+        ops = [
+            pymongo.UpdateOne(
+                { "_id": employee, "record.timestamp": { "$lt": r.get("timestamp") } },
+                { "$set": { "record": r } },
+                upsert=True
+            )
+            for employee, r in newest.items()
+        ]
+        try:
+            client.bulk_write(ops, ordered=False)
+
+        except pymongo.errors.BulkWriteError as e:
+            errors = [err for err in (e.details or {}).get("writeErrors", []) if err.get("code") != 11000]
+            if errors:
+                logger.error(f"Error updating the latest records: {[err.get('errmsg') for err in errors]}")
+
+        except pymongo.errors.PyMongoError as e:
+            logger.error(f"Error updating the latest records: {e}")
+
+    def rebuild_latest(self):
+        """
+        Build the `latest` collection from all the stored records.
+
+        :return: None
+        """
+        records = self.client[self.name]['records']
+        pipeline = [
+            { "$sort": { "attendance_device_id": 1, "timestamp": -1 } },
+            {
+                "$group": {
+                    "_id": "$attendance_device_id",
+                    "latestRecord": { "$first": "$$ROOT" }
+                }
+            },
+            { "$replaceRoot": { "newRoot": "$latestRecord" } }
+        ]
+        logger.info("Building the latest record of every employee...")
+        self.update_latest(list(records.aggregate(pipeline, allowDiskUse=True)))
 
     def close_connection(self):
         """
@@ -58,7 +245,7 @@ class DB:
 
     def collect_latest_records(self):
         """
-        Collect the latest attendance records from the database.
+        Collect the latest attendance record of every employee from the `latest` rollup.
 
         :return: A list of the latest attendance records.
         """
@@ -66,21 +253,9 @@ class DB:
             logger.error("Database connection failed. Cannot collect records.")
             return []
 
-        db = self.get_db('records')
+        db = self.get_db('latest')
         try:
-            pipeline = [
-                { "$sort": { "attendance_device_id": 1, "timestamp": -1 } },
-                {
-                    "$group": {
-                        "_id": "$attendance_device_id",
-                        "latestRecord": { "$first": "$$ROOT" }
-                    }
-                },
-                { "$replaceRoot": { "newRoot": "$latestRecord" } }
-            ]
-
-            latest_records = list(db.aggregate(pipeline))
-            return latest_records
+            return [entry["record"] for entry in db.find({}, { "record": 1 })]
 
         except pymongo.errors.PyMongoError as e:
             logger.error(f"Error fetching records: {e}")
@@ -102,11 +277,141 @@ class DB:
             raise ValueError("Filters must be provided to collect filtered records.")
 
         try:
-            g = list(db.find(filters, {"_id": 0}))
+            g = list(db.find(filters).sort("timestamp", 1))
             return g
 
         except pymongo.errors.PyMongoError as e:
             logger.error(f"Error fetching filtered records: {e}")
             return []
 
+    def stream_filtered_records(self, filters=None, batch_size=500):
+        """
+        Stream attendance records matching the filters in timestamp order,
+        over a single cursor, one batch at a time.
+
+        :param filters: A dictionary of filters to apply to the query.
+        :param batch_size: The number of records in each batch.
+        :return: A generator of lists of attendance records.
+        """
+        if self.client is None:
+            logger.error("Database connection failed. Cannot collect records.")
+            return
+
+        db = self.get_db('records')
+        if not filters:
+            raise ValueError("Filters must be provided to stream filtered records.")
+
+        cursor = db.find(filters, no_cursor_timeout=True).sort("timestamp", 1).batch_size(batch_size)
+        try:
+            batch = []
+            for record in cursor:
+                batch.append(record)
+                if len(batch) >= batch_size:
+                    yield batch
+                    batch = []
+
+            if batch:
+                yield batch
+
+        except pymongo.errors.PyMongoError as e:
+            logger.error(f"Error streaming filtered records: {e}")
+
+        finally:
+            cursor.close()
+
+    def collect_undelivered_records(self, ids=None):
+        """
+        Collect the attendance records that have not been delivered to the ERP yet, oldest first.
+
+        :param ids: An optional list of attendance device IDs to restrict the records to.
+        :return: A list of undelivered attendance records.
+        """
+        if self.client is None:
+            logger.error("Database connection failed. Cannot collect records.")
+            return []
+
+        db = self.get_db('records')
+        filters = { "delivered": False }
+        if ids is not None:
+            filters["attendance_device_id"] = { "$in": ids }
+
+        try:
+            return list(db.find(filters).sort("timestamp", 1))
+
+        except pymongo.errors.PyMongoError as e:
+            logger.error(f"Error fetching undelivered records: {e}")
+            return []
+
+    def mark_delivered(self, ids):
+        """
+        Mark attendance records as delivered to the ERP.
+
+        :param ids: A list of record `_id`s.
+        :return: The number of records marked.
+        """
+        ids = [i for i in ids if i is not None]
+        if not ids:
+            return 0
+
+        db = self.get_db('records')
+        if db is None:
+            logger.error("Database connection failed. Cannot mark records as delivered.")
+            return 0
+
+        try:
+            result = db.update_many(
+                { "_id": { "$in": ids } },
+                { "$set": { "delivered": True, "delivered_at": datetime.now() } }
+            )
+            return result.modified_count
+
+        except pymongo.errors.PyMongoError as e:
+            logger.error(f"Error marking records as delivered: {e}")
+            return 0
+
+    def get_watermark(self, device):
+        """
+        Get the high-water mark of a device, i.e. how far its log has already been read.
+
+        :param device: The device identifier (its IP address).
+        :return: A dictionary with the last `timestamp` and the record `count` read, or None.
+        """
+        client = self.get_db('watermarks')
+        if client is None:
+            logger.error("Database connection failed. Cannot read watermark.")
+            return None
+
+        try:
+            return client.find_one({"_id": device})
+
+        except pymongo.errors.PyMongoError as e:
+            logger.error(f"Error fetching watermark for device {device}: {e}")
+            return None
+
+    def set_watermark(self, device, timestamp, count):
+        """
+        Store the high-water mark of a device.
+
+        :param device: The device identifier (its IP address).
+        :param timestamp: The newest record timestamp that has been stored.
+        :param count: The number of records in the device log that have been read.
+        :return: True if the watermark was stored, False otherwise.
+        """
+        client = self.get_db('watermarks')
+        if client is None:
+            logger.error("Database connection failed. Cannot store watermark.")
+            return False
+
+        try:
+            result = client.update_one(
+                {"_id": device},
+                {"$set": {"timestamp": timestamp, "count": count}},
+                upsert=True
+            )
+            return result.acknowledged
+
+        except pymongo.errors.PyMongoError as e:
+            logger.error(f"Error storing watermark for device {device}: {e}")
+            return False
+
 db = DB()
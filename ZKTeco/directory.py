@@ -0,0 +1,155 @@
+import time
+import pymongo
+from datetime import datetime, timedelta
+from bio_config import directory as directory_config
+from db import db
+from logger import logger
+from metrics import metrics
+
+
+class Directory:
+    """
+    A local copy of the ERP employee list, stored in MongoDB and refreshed
+    incrementally once it is older than its TTL. Lookups from attendance device ID
+    to employee are served from memory, so a run makes at most one directory call.
+    """
+    def __init__(self, source, fetch, ttl=3600):
+        """
+        Initialize the Directory class.
+
+        :param source: The name of the ERP the directory belongs to (e.g. 'erpnext')
+        :param fetch: A function taking the validator of the last refresh and returning
+            a tuple (employees, complete, validator). `employees` is None if nothing changed
+            since the last refresh, and `complete` tells whether it is the whole directory
+            or only the employees that changed. Each employee is a dictionary with the
+            `employee`, `employee_name`, `attendance_device_id` and optionally `active` keys.
+        :param ttl: The number of seconds a refresh stays valid
+        """
+        self.source = source
+        self.fetch = fetch
+        self.ttl = ttl
+        self.entries = None
+        self.by_device = {}
+        self.loaded_at = None
+
+    def load(self, force=False):
+        """
+        Load the directory into memory, refreshing it from the ERP if it has expired.
+
+        :param force: Refresh from the ERP even if the stored copy has not expired
+        :return: The list of active employees
+        """
+        if self.entries is not None and not force and time.monotonic() - self.loaded_at < self.ttl:
+            return self.entries
+
+        employees, meta = db.get_db('employees'), db.get_db('directory')
+        if employees is None or meta is None:
+            logger.warning("Database connection failed. Reading the employee directory straight from the ERP.")
+            fetched, _, _ = self.fetch(None)
+            return self.index(self.normalize(e) for e in fetched or [])
+
+        state = meta.find_one({ "_id": self.source }) or {}
+        expired = not state.get('refreshed_at') or datetime.now() - state['refreshed_at'] > timedelta(seconds=self.ttl)
+        if force or expired:
+            try:
+                self.refresh(employees, meta, state.get('validator'))
+            except Exception as e:
+                if not state:
+                    raise
+                logger.warning(f"Could not refresh the employee directory, using the stored copy: {e}")
+
+        return self.index(employees.find({ "source": self.source }, { "_id": 0 }))
+
+    def refresh(self, employees, meta, validator=None):
+        """
+        Fetch the employees that changed since the last refresh and store them.
+
+        :param employees: The employees collection
+        :param meta: The directory metadata collection
+        :param validator: The validator returned by the last refresh
+        """
+        with metrics.time('directory', transport=self.source):
+            fetched, complete, validator = self.fetch(validator)
+        if fetched is not None:
+            entries = [self.normalize(e) for e in fetched]
+            active = [e for e in entries if e["active"]]
+            inactive = [e["employee"] for e in entries if not e["active"]]
+
+            if active:
+                employees.bulk_write([
+                    pymongo.ReplaceOne({ "source": self.source, "employee": e["employee"] }, e, upsert=True)
+                    for e in active
+                ], ordered=False)
+
+            if complete:
+                employees.delete_many({ "source": self.source, "employee": { "$nin": [e["employee"] for e in active] } })
+            elif inactive:
+                employees.delete_many({ "source": self.source, "employee": { "$in": inactive } })
+
+            logger.info(f"Employee directory refreshed: {len(active)} updated, {len(inactive)} removed.")
+
+        else:
+            logger.info("Employee directory is up to date.")
+
+        meta.update_one(
+            { "_id": self.source },
+            { "$set": { "refreshed_at": datetime.now(), "validator": validator } },
+            upsert=True
+        )
+
+    def normalize(self, employee):
+        """
+        Convert an employee from the ERP into a directory entry.
+
+        :param employee: The employee dictionary returned by the fetch function
+        :return: The directory entry
+        """
+        return {
+            "source": self.source,
+            "employee": employee.get("employee"),
+            "employee_name": employee.get("employee_name"),
+            "attendance_device_id": str(employee.get("attendance_device_id") or employee.get("employee")),
+            "active": employee.get("active", True),
+        }
+
+    def index(self, entries):
+        """
+        Keep the entries in memory and index them by attendance device ID.
+
+        :param entries: An iterable of directory entries
+        :return: The list of entries
+        """
+        self.entries = [e for e in entries if e.get("employee") and e.get("active", True)]
+        self.loaded_at = time.monotonic()
+        self.by_device = { e["attendance_device_id"]: e for e in self.entries }
+        return self.entries
+
+    def employees(self):
+        """
+        Get all active employees.
+
+        :return: A list of directory entries
+        """
+        return self.load()
+
+    def lookup(self, attendance_device_id):
+        """
+        Get the employee identifier for an attendance device ID.
+
+        :param attendance_device_id: The ID of the employee on the biometric devices
+        :return: The employee identifier, or None if it is unknown
+        """
+        self.load()
+        entry = self.by_device.get(str(attendance_device_id))
+        return entry.get("employee") if entry else None
+
+
+def create_directory(source, fetch):
+    """
+    Create the employee directory of an ERP using the TTL from bio_config.
+
+    :param source: The name of the ERP
+    :param fetch: The fetch function of the ERP transport
+    :return: A Directory instance
+    """
+    return Directory(source, fetch, ttl=directory_config.get('ttl', 3600))
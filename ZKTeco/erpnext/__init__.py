@@ -1 +1 @@
-from .transport import get_attendance, get_users, decide
+from .transport import get_users, get_last_checkin, prefetch, bulk_submit, decide
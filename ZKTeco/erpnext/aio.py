@@ -0,0 +1,20 @@
+import asyncio
+from aio_runner import run_ordered
+from erpnext import transport
+
+
+async def decide_many(records: list, concurrency: int=8) -> list:
+    """
+    Decides and submits many records concurrently. Different employees are processed
+    in parallel, the records of one employee are processed in order.
+
+    :param records: A list of check-in records, oldest first
+    :param concurrency: The maximum number of records in flight
+    :return: A list with, for each record, the response or the exception it raised
+    """
+    employees = [ transport.directory.lookup(r.get('attendance_device_id')) for r in records ]
+    await asyncio.to_thread(transport.prefetch, employees)
+    for record, employee in zip(records, employees):
+        record.setdefault('employee', employee)
+
+    return await run_ordered(records, transport.decide, key=lambda r: r.get('employee'), concurrency=concurrency)
@@ -1,10 +1,24 @@
+import json
 import requests
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from erpnext import config
 from erpnext.config import urls, api_url, frappe_api_key, frappe_secret_key
 from erpnext.exceptions import AttendanceFetchError, NetworkError, UnknownResponseError
 from logger import logger
+from http_client import http_client
+from directory import create_directory
+from state import create_state
+from outbox import create_outbox
+from metrics import metrics
 
 
+# Optional settings, read with defaults so that sites do not have to add them to their config.py
+bulk_chunk_size = getattr(config, 'bulk_chunk_size', 200)  # Checkins sent per bulk request
+bulk_max_in_flight = getattr(config, 'bulk_max_in_flight', 4)  # Bulk requests sent at the same time (keep it at or below the http pool_size)
+alternate_log_type = getattr(config, 'alternate_log_type', False)  # Alternate IN/OUT from the previous checkin instead of leaving log_type to the shift settings
+
 default_headers = {
     'Content-Type': 'application/json',
     'Accept': 'application/json',
@@ -25,45 +39,122 @@ def get_time(dt: str|datetime, reverse=False) -> datetime | str:
         return datetime.strptime(dt, '%Y-%m-%d %H:%M:%S') if not reverse else dt.strftime('%Y-%m-%d %H:%M:%S')
 
 
+last_checkins = {}  # The last checkin of each employee, built once per run by prefetch()
+
+
 def get_last_checkin(uid) -> dict:
     """
-    Fetches attendance data for a specific user from the erpnext API.
+    Fetches the last checkin of a specific employee, served from the prefetched map.
 
-    :param uid: The unique identifier for the user
-    :param auth: A dictionary containing authentication details (access token)
-    :return: A dictionary containing the attendance data
+    :param uid: The employee identifier
+    :return: A dictionary containing the last checkin, empty if the employee has none
     """
-    url = "{}{}?filters={}&limit_page_length=1&order_by={}&fields={}".format(
-        api_url, urls['checkin'], {'employee': uid},
-        'max(time) desc', ["employee", "max(time) as time", "log_type"]
-    )
-    response = requests.get(url, headers=default_headers)
+    return prefetch([uid]).get(uid, {})
 
-    if response.status_code == 200:
-        data = response.json()["data"] if isinstance(response.json()["data"], dict) else {}
-        return data[0]
 
-    else:
-        raise AttendanceFetchError(f"Failed to fetch attendance data for user {uid}: {response.text}")
+def get_all_checkins(ids: list = [], page_length: int = 500) -> list:
+    """
+    Fetches the last checkin of each of the given employees from the erpnext API,
+    paging through the results grouped by employee so that no employee is cut off.
 
+    :param ids: A list of employee identifiers (all employees if empty)
+    :param page_length: The number of employees fetched per page
+    :return: A list of dictionaries containing the employee, time and log_type of the last checkins
+    """
+    if len(ids) > page_length:  # Keep the employee filter short enough for a URL
+        return [c for start in range(0, len(ids), page_length) for c in get_all_checkins(ids[start:start + page_length], page_length)]
+
+    url = f"{api_url}{urls['checkin']}"
+    filters = [["employee", "in", ids]] if ids else []
+    latest = {}
+    start = 0
+    while True:
+        params = {
+            "filters": json.dumps(filters),
+            "fields": json.dumps(["employee", "max(time) as time"]),
+            "group_by": "employee",
+            "order_by": "employee asc",
+            "limit_start": start,
+            "limit_page_length": page_length,
+        }
+        response = http_client.get(url, params=params, headers=default_headers)
+        if response.status_code != 200:
+            raise AttendanceFetchError(f"Failed to fetch attendance data for users {ids}: {response.text}")
+
+        page = response.json().get("data", [])
+        latest.update({ i.get('employee'): str(i.get('time')).split('.')[0] for i in page if i.get('time') })
+        if len(page) < page_length:
+            break
+        start += page_length
+
+    if not latest:
+        return []
+
+    # The grouped query cannot tell which log_type belongs to the latest time, so look the rows up
+    employees = list(latest)
+    checkins = []
+    for start in range(0, len(employees), page_length):
+        chunk = employees[start:start + page_length]
+        params = {
+            "filters": json.dumps([["employee", "in", chunk], ["time", "in", [latest[e] for e in chunk]]]),
+            "fields": json.dumps(["employee", "time", "log_type"]),
+            "limit_page_length": 0,
+        }
+        response = http_client.get(url, params=params, headers=default_headers)
+        if response.status_code != 200:
+            raise AttendanceFetchError(f"Failed to fetch attendance data for users {chunk}: {response.text}")
+
+        found = {
+            i.get('employee'): i for i in response.json().get("data", [])
+            if str(i.get('time')).split('.')[0] == latest.get(i.get('employee'))
+        }
+        checkins.extend(
+            { "employee": e, "time": latest[e], "log_type": found.get(e, {}).get('log_type') }
+            for e in chunk
+        )
 
-def get_all_checkins(ids: list = []) -> list:
+    return checkins
+
+
+def prefetch(employees: list, cache: dict=None) -> dict:
     """
-    Fetches attendance data for a list of users from the erpnext API.
+    Builds the last checkin map for the given employees, fetching only the ones not in it yet.
+    Employees without any checkin are stored with an empty dictionary.
 
-    :param ids: A list of user identifiers
-    :return: A list of dictionaries containing the attendance data
+    :param employees: A list of employee identifiers
+    :param cache: The map to fill (defaults to the module-wide last_checkins map)
+    :return: The filled map
     """
-    url = "{}{}?filters={}&group_by='employee'&order_by={}&fields={}".format(
-        api_url, urls['checkin'], {'employee': ["in", ids]} if ids else {},
-        'max(time) desc', ["employee", "max(time) as time", "log_type"]
-    )
-    response = requests.get(url, headers=default_headers)
-    if response.status_code == 200:
-        data = response.json().get("data", [])
-        return data
-    else:
-        raise AttendanceFetchError(f"Failed to fetch attendance data for users {ids}: {response.text}")
+    cache = last_checkins if cache is None else cache
+    missing = list({ e for e in employees if e } - set(cache))
+    if missing:
+        stored = checkin_state.get_many(missing)
+        for employee, entry in stored.items():
+            cache[employee] = { "employee": employee, "time": get_time(entry['time'], True), "log_type": entry.get('log_type') }
+        missing = [e for e in missing if e not in stored]
+
+    if missing:
+        with metrics.time('prefetch', transport='erpnext'):
+            found = { i.get('employee'): i for i in get_all_checkins(missing, page_length=100) }
+        for employee in missing:
+            cache[employee] = found.get(employee, {})
+            if employee in found:
+                checkin_state.record(employee, get_time(found[employee]['time']), found[employee].get('log_type'), source='erp')
+
+    return cache
+
+
+def fetch_state() -> list:
+    """
+    Fetches the last checkin of every employee in the directory, for reconciling the local check-in state.
+
+    :return: A list of dictionaries with the employee, time (datetime) and log_type of the last checkins
+    """
+    employees = [ e.get('employee') for e in directory.employees() ]
+    return [
+        { "employee": c['employee'], "time": get_time(c['time']), "log_type": c.get('log_type') }
+        for c in get_all_checkins(employees, page_length=100)
+    ]
 
 
 def get_users(filters: dict={}, fields: list=[]) -> dict:
@@ -76,7 +167,7 @@ def get_users(filters: dict={}, fields: list=[]) -> dict:
 
     filters = {"attendance_device_id": filters.get('user')} if filters.get('user') else filters
     url = "{}{}?filters={}&fields={}".format(api_url, urls['employee'], {**filters, "status": "Active"}, ["employee", "employee_name", "attendance_device_id"])
-    response = requests.get(url, headers=default_headers)
+    response = http_client.get(url, headers=default_headers)
 
     if response.status_code == 200:
         data = response.json().get("data")
@@ -85,47 +176,146 @@ def get_users(filters: dict={}, fields: list=[]) -> dict:
         raise UnknownResponseError(f"Failed to fetch employee data: {response.text}")
 
 
-def bulk_submit(records: list, ids: list=[]) -> requests.Response:
+def fetch_directory(validator: str=None) -> tuple:
+    """
+    Fetches the employees for the local directory from the erpnext API.
+    The first call fetches every active employee, later calls only fetch the
+    employees modified since the previous one.
+
+    :param validator: The newest `modified` value seen by the previous call
+    :return: A tuple (employees, complete, validator) as expected by Directory
+    """
+    filters = [["modified", ">", validator]] if validator else [["status", "=", "Active"]]
+    params = {
+        "filters": json.dumps(filters),
+        "fields": json.dumps(["employee", "employee_name", "attendance_device_id", "status", "modified"]),
+        "limit_page_length": 0,
+    }
+    response = http_client.get(f"{api_url}{urls['employee']}", params=params, headers=default_headers)
+    if response.status_code != 200:
+        raise UnknownResponseError(f"Failed to fetch employee data: {response.text}")
+
+    data = response.json().get("data", [])
+    if not data:
+        return None, False, validator
+
+    for employee in data:
+        employee['active'] = employee.get('status') == 'Active'
+
+    return data, not validator, max(str(e.get('modified')) for e in data)
+
+
+def bulk_submit(records: list, ids: list=[], state: dict=None) -> list:
     """
     Sends a bulk request to the erpnext API to process checkin logs.
 
     :param records: A list of checkin logs to be processed
-    :param attendances: A list of checkin logs to be checked against
-    :return: The response from the API
+    :param ids: A list of attendance device IDs to process
+    :param state: An optional per-employee last checkin map, kept between calls when importing in batches
+    :return: The positions in `records` of the records that could not be processed
     """
     url = "{}{}".format(api_url, urls['bulk_submit'])
-    employees = get_users(filters={"attendance_device_id": ["in", ids]})
-    employees = { i.get('attendance_device_id'): i.get("employee") for i in employees }
-    last_attendances_dict = { i.employee: i for i in get_all_checkins() }
+    last_attendances_dict = prefetch([ directory.lookup(r.get('attendance_device_id')) for r in records ], state)
     collected = []
-    for record in records:
-        sep = employees.get(record.get('attendance_device_id'))
+    failed = []
+    for i, record in enumerate(records):
+        sep = directory.lookup(record.get('attendance_device_id'))
         try:
             record['attendance_device_id'] = record.get('attendance_device_id')
             record.update({'timestamp': get_time(record.get('timestamp'), True), "employee": sep})
-            last = last_attendances_dict.get(sep, {})
-            res = decide(record, False, last)
+            res = decide(record, False, last_attendances_dict.get(sep, {}))
             if res:
-                collected.append(res)
+                collected.append((i, res))
                 if sep not in last_attendances_dict:
-                    last_attendances_dict[sep] = record
+                    last_attendances_dict[sep] = res
                 else:
-                    last_attendances_dict[sep].update(record)
+                    last_attendances_dict[sep].update(res)
 
         except Exception as error:
+            failed.append(i)
             logger.error(f'Error processing record {sep}: {error}')
 
     if len(collected) == 0:
-        return requests.Response()
+        return failed
+
+    # Write the logs to the outbox first, the ones that fail below are retried from there
+    fresh = outbox.enqueue([('checkin', log, checkin_key(log)) for _, log in collected])
+    if fresh is not None:
+        collected = [(i, log) for i, log in collected if checkin_key(log) in fresh]
+
+    undecided = len(failed)
+    chunks = [collected[i:i + bulk_chunk_size] for i in range(0, len(collected), bulk_chunk_size)]
+    unavailable = threading.Event()
+    with ThreadPoolExecutor(max_workers=max(1, bulk_max_in_flight)) as executor:
+        results = list(executor.map(lambda chunk: submit_chunk(url, chunk, unavailable), chunks))
+
+    for n, (chunk, chunk_failed) in enumerate(zip(chunks, results), start=1):
+        if chunk_failed:
+            logger.warning(f'Chunk {n}/{len(chunks)}: {len(chunk) - len(chunk_failed)} of {len(chunk)} checkins submitted')
+        else:
+            logger.info(f'Chunk {n}/{len(chunks)}: {len(chunk)} checkins submitted')
+        failed.extend(chunk_failed)
 
-    response = requests.post(url, json={"docs": collected}, headers=default_headers)
-    if response.status_code == 200:
-        logger.info(response.json())
-        return response
-    else:
-        raise UnknownResponseError(f"Failed to send bulk attendance records: {response.text}")
+    rejected = set(failed)
+    latest = { log['employee']: log for i, log in collected if i not in rejected }
+    for employee, log in latest.items():
+        checkin_state.record(employee, get_time(log['time']), log.get('log_type'))
+
+    if fresh is None:
+        return failed
+
+    outbox.mark_sent([checkin_key(log) for i, log in collected if i not in rejected])
+    if rejected:
+        logger.warning(f'{len(rejected)} checkins were left in the outbox to be retried')
+    return failed[:undecided]  # Only the records that could not be decided, the rest are in the outbox
+
+
+rejections = { 400, 409, 413, 417 }  # Responses rejecting documents of a chunk, rather than the whole request
 
 
+def submit_chunk(url: str, chunk: list, unavailable: threading.Event=None) -> list:
+    """
+    Sends one chunk of checkin logs to the erpnext API. If the server rejects documents
+    of the chunk (400, 409, 413 or a 417 ValidationError), it is split in half and each
+    half is retried, down to single logs, so that one bad log does not keep the rest of the
+    chunk from being inserted. Any other failure (a 5xx response, a wrong API key, a missing
+    DocType, rate limiting or a transport error) fails the whole chunk at once and leaves it in the outbox.
+
+    :param url: The bulk submit URL
+    :param chunk: A list of (record position, checkin log) pairs
+    :param unavailable: An optional Event shared by the chunks of a submit, set once the server fails,
+                        so that the remaining chunks are not sent to a server that is down
+    :return: The record positions of the logs that could not be inserted
+    """
+    if unavailable is not None and unavailable.is_set():
+        return [i for i, _ in chunk]
+
+    try:
+        with metrics.time('submit', transport='erpnext', mode='bulk'):
+            response = http_client.post(url, json={"docs": [doc for _, doc in chunk]}, headers=default_headers)
+        if response.status_code == 200:
+            metrics.inc('submissions', len(chunk), transport='erpnext', outcome='sent', mode='bulk')
+            return []
+        error, rejected = response.text, response.status_code in rejections
+
+    except requests.RequestException as e:
+        error, rejected = str(e), False
+
+    if not rejected:
+        if unavailable is not None:
+            unavailable.set()
+        logger.error(f"Failed to send {len(chunk)} checkins: {error}")
+        return [i for i, _ in chunk]
+
+    if len(chunk) == 1:
+        logger.error(f"Failed to send checkin {chunk[0][1]}: {error}")
+        return [chunk[0][0]]
+
+    middle = len(chunk) // 2
+    return submit_chunk(url, chunk[:middle], unavailable) + submit_chunk(url, chunk[middle:], unavailable)
+
+
+@metrics.timed('decide', transport='erpnext')
 def decide(d, submit=True, last=None) -> requests.Response | dict | None:
     """
     Logic to handle check-in/check-out based on the provided data.
@@ -135,8 +325,9 @@ def decide(d, submit=True, last=None) -> requests.Response | dict | None:
     :return: The response from the API
     """
     rt = get_time(d.get('timestamp'))
-    employee = d.get("employee") or get_users(filters={"user": d.get("attendance_device_id")}).get('employee')
-    prev = last or get_last_checkin(employee)
+    employee = d.get("employee") or directory.lookup(d.get("attendance_device_id"))
+    prev = last if last is not None else get_last_checkin(employee)
+    previous_type = "log_type" if alternate_log_type else "status"
     if prev:
         time: datetime = get_time(prev.get("time"))
         if rt <= time:
@@ -145,16 +336,83 @@ def decide(d, submit=True, last=None) -> requests.Response | dict | None:
             log = {
                 "employee": employee,
                 "time": get_time(rt, True),
-                "log_type": ("OUT" if prev.get("status") == "IN" else "IN") if prev.get("status") else None, # If we don't get a status, that might mean that hr shift type is using "Alternating entries as IN and OUT during the same shift" for "determine_check_in_and_check_out" setting
+                "log_type": ("OUT" if prev.get(previous_type) == "IN" else "IN") if prev.get(previous_type) else None, # If we don't get a log type, that might mean that hr shift type is using "Alternating entries as IN and OUT during the same shift" for "determine_check_in_and_check_out" setting
             }
-            return send_checkin(log) if submit else log
     else:
         log = {
             "employee": employee,
             "time": get_time(rt, True),
             "log_type": "IN", # The HR user will have to correct this status if it was OUT instead, but we can assume that if there is no previous attendance record, then this is a check-in
         }
-        return send_checkin(log) if submit else log
+
+    if not submit:
+        return log
+
+    response = outbox.submit('checkin', log, checkin_key(log))
+    # Only once the log is sent or safely queued, the next punches are decided from it
+    last_checkins[employee] = log
+    checkin_state.record(employee, rt, log['log_type'])
+    return response
+
+
+def checkin_key(log: dict) -> str:
+    """
+    Builds the idempotency key of a checkin log, a punch is only ever queued once.
+
+    :param log: The checkin log
+    :return: The idempotency key
+    """
+    return f"{log.get('employee')}:{log.get('time')}"
+
+
+def checkin_exists(log: dict) -> bool:
+    """
+    Checks whether a checkin log is already in the erpnext API.
+
+    :param log: The checkin log
+    :return: True if a checkin of the same employee at the same time exists
+    """
+    params = {
+        "filters": json.dumps([["employee", "=", log.get('employee')], ["time", "=", log.get('time')]]),
+        "fields": json.dumps(["name"]),
+        "limit_page_length": 1,
+    }
+    response = http_client.get(f"{api_url}{urls['checkin']}", params=params, headers=default_headers)
+    if response.status_code != 200:
+        raise UnknownResponseError(f"Failed to look up checkin: {response.text}")
+
+    return bool(response.json().get("data"))
+
+
+def send_queued(kind: str, payload: dict, attempts: int) -> requests.Response | None:
+    """
+    Sends a checkin log from the outbox. A retried log is only sent if the earlier
+    attempt did not reach the erpnext API, so a timeout never creates a duplicate.
+
+    :param kind: The kind of submission, always 'checkin'
+    :param payload: The checkin log
+    :param attempts: The number of earlier failed attempts
+    :return: The response from the API, or None if the log was already there
+    """
+    try:
+        if attempts and checkin_exists(payload):
+            return None
+    except requests.RequestException as e:
+        raise NetworkError(f"Network error occurred while looking up checkin: {str(e)}")
+
+    return send_checkin(payload)
+
+
+def drop_state(kind: str, payload: dict):
+    """
+    Forgets the check-in state of an employee whose checkin log was dead-lettered, the
+    state was built from a log the erpnext API never received.
+
+    :param kind: The kind of submission, always 'checkin'
+    :param payload: The checkin log
+    """
+    last_checkins.pop(payload.get('employee'), None)
+    checkin_state.forget(payload.get('employee'))
 
 
 def send_checkin(data: dict) -> requests.Response:
@@ -167,11 +425,11 @@ def send_checkin(data: dict) -> requests.Response:
     try:
         if data.get('timestamp'):
             data['time'] = data.pop('timestamp')
-        else:
+        elif not data.get('time'):
             raise ValueError("Timestamp is required for checkin data.")
 
         url = f"{api_url}{urls['checkin']}"
-        response = requests.post(url, json=data, headers=default_headers)
+        response = http_client.post(url, json=data, headers=default_headers)
 
         if response.status_code == 200:
             return response
@@ -180,3 +438,17 @@ def send_checkin(data: dict) -> requests.Response:
 
     except requests.RequestException as e:
         raise NetworkError(f"Network error occurred while clocking out: {str(e)}")
+
+
+def reset():
+    """
+    Forgets the state cached in memory during a run, so that a long-running
+    process starts every cycle from the stored check-in state.
+    """
+    last_checkins.clear()
+    checkin_state.cache.clear()
+
+
+directory = create_directory('erpnext', fetch_directory)
+checkin_state = create_state('erpnext', fetch_state)
+outbox = create_outbox('erpnext', send_queued, on_dead=drop_state)
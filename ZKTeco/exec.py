@@ -1,18 +1,45 @@
 #!/usr/bin/env python3
+import threading
+from contextlib import contextmanager
 from zk import ZK
+from metrics import metrics
 
-def exec(device, func, *args, **kwargs):
+
+class Session:
     """
-    Executes a function on the ZK connection object.
-    
-    :param device: The device configuration dictionary containing connection details.
-    :param func: The name of the function to execute on the ZK connection.
-    :param args: Positional arguments to pass to the function.
-    :param kwargs: Keyword arguments to pass to the function.
+    A single connection to a device that stays open across several operations.
+
+    Use it as a context manager to run a whole sequence of operations over one
+    connection; the device is re-enabled (if it was disabled) and disconnected on exit.
     """
-    conn = None
+    def __init__(self, device):
+        """
+        Initialize the Session class.
 
-    try:
+        :param device: The device configuration dictionary containing connection details.
+        """
+        self.device = device
+        self.conn = None
+        self.disabled = False
+        self.reused = False
+
+    @property
+    def connected(self):
+        """
+        Whether the underlying ZK connection is open.
+        """
+        return self.conn is not None and getattr(self.conn, 'is_connect', False)
+
+    def open(self):
+        """
+        Opens the connection to the device if it is not already open.
+
+        :return: The session itself
+        """
+        if self.connected:
+            return self
+
+        device = self.device
         zk = ZK(
             device["ip"],
             port=device.get("port", 4370),
@@ -21,19 +48,182 @@ def exec(device, func, *args, **kwargs):
             force_udp=device.get("force_udp", False),
             ommit_ping=device.get("ommit_ping", False)
         )
-        conn = zk.connect()
-        if not hasattr(conn, func):
+        with metrics.time('connect', device=device["ip"]):
+            self.conn = zk.connect()
+        self.disabled = False
+        return self
+
+    def run(self, func, *args, **kwargs):
+        """
+        Executes a function on the open ZK connection.
+
+        :param func: The name of the function to execute on the ZK connection.
+        :param args: Positional arguments to pass to the function.
+        :param kwargs: Keyword arguments to pass to the function.
+        """
+        self.open()
+        if not hasattr(self.conn, func):
             raise AttributeError(f"ZK object has no attribute '{func}'")
 
-        return getattr(conn, func)(*args, **kwargs)
-    
-    except Exception as e:
-        raise Exception(f"An error occurred while executing '{func}': {e}")
+        try:
+            result = getattr(self.conn, func)(*args, **kwargs)
+        except Exception as e:
+            stale, self.reused = self.reused, False
+            self.drop()
+            if stale:  # A warm connection may have died with the device (e.g. a reboot), retry once on a fresh one
+                return self.run(func, *args, **kwargs)
+            raise Exception(f"An error occurred while executing '{func}': {e}")
+
+        self.reused = False
+
+        if func == 'disable_device':
+            self.disabled = True
+        elif func == 'enable_device':
+            self.disabled = False
+
+        return result
+
+    def capture(self, timeout=10):
+        """
+        Subscribes to the punches of the device as they happen (pyzk live capture).
+        Yields each punch, or None whenever `timeout` seconds pass without one.
+        The subscription ends once stop_capture() is called and the current wait is over.
+
+        :param timeout: The number of seconds to wait for a punch before yielding None.
+        """
+        self.open()
+        try:
+            for attendance in self.conn.live_capture(new_timeout=timeout):
+                yield attendance
+        except Exception as e:
+            self.drop()
+            raise Exception(f"An error occurred while executing 'live_capture': {e}")
+
+    def stop_capture(self):
+        """
+        Asks a running capture() to end after its current wait.
+        """
+        if self.conn:
+            self.conn.end_live_capture = True
+
+    def release(self):
+        """
+        Re-enables the device if this session disabled it, keeping the connection open.
+        """
+        if self.connected and self.disabled:
+            try:
+                self.conn.enable_device()
+                self.disabled = False
+            except Exception as e:
+                print(f"An error occurred while re-enabling the device: {e}")
+                self.disabled = False  # Already attempted, do not try again while dropping
+                self.drop()
+
+    def drop(self):
+        """
+        Discards the connection after an error. The device is re-enabled first if this
+        session disabled it, so that a failed operation never leaves the terminal disabled.
+        """
+        if self.conn:
+            if self.disabled:
+                try:
+                    self.conn.enable_device()
+                except Exception as e:
+                    print(f"An error occurred while re-enabling the device: {e}")
+            try:
+                self.conn.disconnect()
+            except Exception:
+                pass
+        self.conn = None
+        self.disabled = False
 
-    finally:
-        if conn:
+    def close(self):
+        """
+        Re-enables the device if needed and disconnects from it.
+        """
+        if self.conn:
+            self.release()
             try:
-                conn.enable_device()  # Re-enable the device after operations
-                conn.disconnect()
+                if self.conn:
+                    self.conn.disconnect()
             except Exception as e:
                 print(f"An error occurred while disconnecting: {e}")
+        self.conn = None
+        self.disabled = False
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+
+class SessionPool:
+    """
+    Keeps one open session per device so that long-running processes
+    do not reconnect and re-authenticate on every cycle.
+    """
+    def __init__(self):
+        """
+        Initialize the SessionPool class.
+        """
+        self.sessions = {}
+        self.locks = {}
+        self.lock = threading.Lock()
+
+    def _key(self, device):
+        return (device["ip"], device.get("port", 4370))
+
+    @contextmanager
+    def session(self, device):
+        """
+        Borrows the warm session of a device, opening it if necessary.
+        Only one caller may use a device's session at a time.
+
+        :param device: The device configuration dictionary containing connection details.
+        """
+        key = self._key(device)
+        with self.lock:
+            lock = self.locks.setdefault(key, threading.Lock())
+            session = self.sessions.setdefault(key, Session(device))
+
+        with lock:
+            session.reused = session.connected
+            try:
+                yield session.open()
+            except Exception:
+                session.drop()
+                raise
+            finally:
+                session.release()
+
+    def close_all(self):
+        """
+        Closes every pooled session.
+        """
+        with self.lock:
+            sessions = list(self.sessions.values())
+            self.sessions.clear()
+
+        for session in sessions:
+            session.close()
+
+
+def exec(device, func, *args, **kwargs):
+    """
+    Executes a single function on a fresh connection to the device.
+    Prefer a Session when running several operations on the same device.
+
+    :param device: The device configuration dictionary containing connection details.
+    :param func: The name of the function to execute on the ZK connection.
+    :param args: Positional arguments to pass to the function.
+    :param kwargs: Keyword arguments to pass to the function.
+    """
+    try:
+        session = Session(device).open()
+    except Exception as e:
+        raise Exception(f"An error occurred while executing '{func}': {e}")
+
+    with session:
+        return session.run(func, *args, **kwargs)
@@ -0,0 +1,107 @@
+import random
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from bio_config import http
+from logger import logger
+
+
+class JitteredRetry(Retry):
+    """
+    A Retry policy that adds random jitter to the exponential backoff,
+    so that concurrent workers do not retry against the ERP in lockstep.
+    """
+    def get_backoff_time(self):
+        backoff = super().get_backoff_time()
+        return backoff + random.uniform(0, backoff) if backoff else 0
+
+
+class HTTPClient:
+    """
+    A shared HTTP client for the ERP transports.
+    It keeps connections alive in a pool, retries idempotent requests with
+    jittered backoff and applies a timeout to every request.
+    """
+    def __init__(self, pool_size=10, retries=3, backoff=0.5, timeout=30):
+        """
+        Initialize the HTTPClient class.
+
+        :param pool_size: The number of keep-alive connections kept per host
+        :param retries: How many times idempotent requests are retried
+        :param backoff: The base backoff between retries, in seconds
+        :param timeout: The default timeout of a request, in seconds
+        """
+        self.pool_size = pool_size
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.session = None
+        self.lock = threading.Lock()
+
+    def get_session(self):
+        """
+        Get the pooled session, creating it on first use.
+
+        :return: A requests.Session instance
+        """
+        if self.session:
+            return self.session
+
+        with self.lock:
+            if self.session is None:
+                retry = JitteredRetry(
+                    total=self.retries,
+                    backoff_factor=self.backoff,
+                    status_forcelist=(429, 502, 503, 504),
+                    allowed_methods=Retry.DEFAULT_ALLOWED_METHODS,  # POST is not idempotent and is never retried
+                    raise_on_status=False,
+                    respect_retry_after_header=True
+                )
+                adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size, max_retries=retry)
+                session = requests.Session()
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                self.session = session
+
+        return self.session
+
+    def request(self, method, url, **kwargs) -> requests.Response:
+        """
+        Send a request through the pooled session.
+
+        :param method: The HTTP method
+        :param url: The URL to send the request to
+        :param kwargs: Keyword arguments passed on to requests
+        :return: The response
+        """
+        kwargs.setdefault('timeout', self.timeout)
+        return self.get_session().request(method, url, **kwargs)
+
+    def get(self, url, **kwargs) -> requests.Response:
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs) -> requests.Response:
+        return self.request('POST', url, **kwargs)
+
+    def close(self):
+        """
+        Close the pooled connections.
+
+        :return: None
+        """
+        with self.lock:
+            if self.session is not None:
+                try:
+                    self.session.close()
+                except Exception as e:
+                    logger.error(f"Error closing HTTP session: {e}")
+                self.session = None
+
+
+http_client = HTTPClient(
+    pool_size=http.get('pool_size', 10),
+    retries=http.get('retries', 3),
+    backoff=http.get('backoff', 0.5),
+    timeout=http.get('timeout', 30)
+)
@@ -20,19 +20,5 @@ if ! date -d "$end_date" >/dev/null 2>&1; then
     exit 1
 fi
 
-current_date="$start_date"
-
-# Loop including the end date
-while [[ "$current_date" < "$end_date" ]] || [[ "$current_date" == "$end_date" ]]; do
-    next_date=$(date -I -d "$current_date + 1 day")
-
-    python3 main.py --verbose -m "$3" --import "$current_date" "$next_date" -b
-
-    # Break if we reached the end date
-    if [[ "$current_date" == "$end_date" ]]; then
-        break
-    fi
-
-    sleep 30
-    current_date=$(date -I -d "$next_date + 1 day")
-done
+# main.py streams the whole range in batches and paces itself (see `importer` in bio_config.py)
+python3 main.py --verbose -m "$3" --import "$start_date" "$end_date" -b
@@ -0,0 +1,14 @@
+from aio_runner import run_ordered
+from laravel import transport
+
+
+async def decide_many(records: list, concurrency: int=8) -> list:
+    """
+    Decides and submits many records concurrently. Different users are processed
+    in parallel, the records of one user are processed in order.
+
+    :param records: A list of attendance records, oldest first
+    :param concurrency: The maximum number of records in flight
+    :return: A list with, for each record, the response or the exception it raised
+    """
+    return await run_ordered(records, transport.decide, key=lambda r: str(r.get('attendance_device_id')), concurrency=concurrency)
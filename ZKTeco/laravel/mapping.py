@@ -0,0 +1,112 @@
+COPY, SPLIT, JOIN = 0, 1, 2
+
+
+class FieldMap:
+    """
+    A precompiled mapping between our field names and the laravel API field names.
+
+    Each pair maps one of our fields to one laravel field. A laravel field written as
+    `a+b` is made of several fields: going to laravel the value is split on spaces
+    into `a` and `b`, coming back from laravel `a` and `b` are joined with a space.
+    The lookup tables for both directions are built once, when the map is created.
+    """
+    def __init__(self, pairs: list):
+        """
+        Initialize the FieldMap class.
+
+        :param pairs: A list of (our field, laravel field) tuples
+        """
+        self.rules = { False: self.compile(pairs), True: self.compile([(theirs, ours) for ours, theirs in pairs]) }
+        self.consumed = {
+            direction: frozenset(source for kind, source, _ in rules if kind != JOIN)
+            for direction, rules in self.rules.items()
+        }
+
+    @staticmethod
+    def compile(pairs: list) -> tuple:
+        """
+        Builds the conversion rules of one direction.
+
+        :param pairs: A list of (source field, target field) tuples
+        :return: A tuple of (kind, source, target) rules
+        """
+        rules = []
+        for source, target in pairs:
+            if '+' in source:
+                rules.append((JOIN, tuple(source.split('+')), target))
+            elif '+' in target:
+                rules.append((SPLIT, source, tuple(target.split('+'))))
+            else:
+                rules.append((COPY, source, target))
+
+        return tuple(rules)
+
+    def convert(self, data: dict, reverse: bool=False, keeps: list=None) -> dict:
+        """
+        Converts a single record. The record itself is left untouched.
+
+        :param data: The record to convert
+        :param reverse: If True, converts from laravel to our field names
+        :param keeps: List of fields to keep in the converted record
+        :return: The converted record
+        """
+        return self.apply(data, self.rules[reverse], self.consumed[reverse], keeps)
+
+    def convert_many(self, records: list, reverse: bool=False, keeps: list=None) -> list:
+        """
+        Converts a list of records at once. The records themselves are left untouched.
+
+        :param records: The records to convert
+        :param reverse: If True, converts from laravel to our field names
+        :param keeps: List of fields to keep in the converted records
+        :return: A list of converted records
+        """
+        rules, consumed, apply = self.rules[reverse], self.consumed[reverse], self.apply
+        return [apply(data, rules, consumed, keeps) for data in records]
+
+    @staticmethod
+    def apply(data: dict, rules: tuple, consumed: frozenset, keeps: list=None) -> dict:
+        """
+        Builds the converted record in a single pass over the rules.
+        Fields without a rule are carried over as they are.
+
+        :param data: The record to convert
+        :param rules: The rules of the conversion direction
+        :param consumed: The source fields that are renamed by the rules
+        :param keeps: List of fields to keep in the converted record
+        :return: The converted record
+        """
+        formatted = { k: v for k, v in data.items() if k not in consumed }
+        for kind, source, target in rules:
+            if kind == COPY:
+                if source in data:
+                    formatted[target] = data[source]
+
+            elif kind == SPLIT:
+                if source in data:
+                    values = (data[source] or '').strip().split(' ')
+                    if len(values) == len(target):
+                        formatted.update(zip(target, values))
+
+            else:
+                values = [data.get(k, '') for k in source]
+                values = [v for v in values if v is not None]
+                joined = ' '.join(values).strip() if all(values) else None
+                if joined:
+                    formatted[target] = joined
+
+        return { k: formatted[k] for k in keeps if k in formatted } if keeps else formatted
+
+
+fields = FieldMap([
+    ("employee", "id"),
+    ("employee_name", "first_name+last_name"),
+    ("attendance_date", "date"),
+    ("company", "business_id"),
+    ("check_in", "clock_in_time"),
+    ("check_out", "clock_out_time"),
+    ("status", "status"),
+    ("attendance_device_id", "user_id"),
+    ("default_shift", "essentials_shift_id"),
+    ("device", "ip_address"),
+])
@@ -1,9 +1,20 @@
 import requests
-from datetime import datetime
-from laravel.utils import load_storage, format_data, try_auth
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from laravel.utils import load_storage, format_data
+from laravel import config
 from laravel.config import urls, business_id, api_url
+from laravel.mapping import fields as mapping
 from laravel.exceptions import AttendanceFetchError, AuthenticationError, NetworkError, AuthenticationError, UnknownResponseError, TokenRefreshError
 from logger import logger
+from http_client import http_client
+from directory import create_directory
+from state import create_state
+from outbox import create_outbox
+from metrics import metrics
+
+# Optional settings, read with defaults so that sites do not have to add them to their config.py
+prefetch_workers = getattr(config, 'prefetch_workers', 4)  # Days of attendance fetched at the same time by bulk submits
 
 default_headers = {
     'Content-Type': 'application/json',
@@ -41,7 +52,7 @@ def get_attendance(uid, auth) -> dict:
 
     url = f"{api_url}{urls['attendance']}/{uid}?business_id={business_id}"
 
-    response = requests.get(url, headers=headers)
+    response = http_client.get(url, headers=headers)
 
     if response.status_code == 200:
         data = response.json()["data"] if isinstance(response.json()["data"], dict) else {'id': None}
@@ -61,24 +72,54 @@ def get_users(filters: dict={}, fields: list=[]) -> dict:
     """
 
     auth = load_storage()
-    if not auth or 'access_token' not in auth:
-        auth = try_auth()
 
     headers = { 'Authorization': f"Bearer {auth['access_token']}", **default_headers }
 
     user = f'/{filters.get('user')}' if filters.get('user') else ''
     url = f"{api_url}{urls['employee']}{user}?business_id={business_id}"
 
-    response = requests.get(url, headers=headers)
+    response = http_client.get(url, headers=headers)
 
     if response.status_code == 200:
         data = response.json().get("data")
-        data = [format_data(item, True, fields) for item in data] if isinstance(data, list) else format_data(data, True, fields)
+        data = mapping.convert_many(data, True, fields) if isinstance(data, list) else mapping.convert(data, True, fields)
         return data
     else:
         raise UnknownResponseError(f"Failed to fetch employee data: {response.text}")
 
 
+def fetch_directory(validator: dict=None) -> tuple:
+    """
+    Fetches the employees for the local directory from the laravel API.
+    The request is conditional on the ETag / Last-Modified of the previous call,
+    so an unchanged employee list is not downloaded again.
+
+    :param validator: The validators returned by the previous call
+    :return: A tuple (employees, complete, validator) as expected by Directory
+    """
+    auth = load_storage()
+
+    headers = { 'Authorization': f"Bearer {auth['access_token']}", **default_headers }
+    validator = validator or {}
+    if validator.get('etag'):
+        headers['If-None-Match'] = validator['etag']
+    if validator.get('last_modified'):
+        headers['If-Modified-Since'] = validator['last_modified']
+
+    url = f"{api_url}{urls['employee']}?business_id={business_id}"
+    response = http_client.get(url, headers=headers)
+
+    if response.status_code == 304:
+        return None, True, validator
+
+    elif response.status_code == 200:
+        data = mapping.convert_many(response.json().get("data") or [], True, ["employee", "employee_name", "attendance_device_id"])
+        return data, True, { "etag": response.headers.get('ETag'), "last_modified": response.headers.get('Last-Modified') }
+
+    else:
+        raise UnknownResponseError(f"Failed to fetch employee data: {response.text}")
+
+
 def get_bulk_attendance(date: str, auth) -> list:
     """
     Fetches bulk attendance data for a specific date from the laravel API.
@@ -94,7 +135,7 @@ def get_bulk_attendance(date: str, auth) -> list:
 
     url = f"{api_url}{urls['bulk_attendance']}?date={date}&business_id={business_id}"
 
-    response = requests.get(url, headers=headers)
+    response = http_client.get(url, headers=headers)
 
     if response.status_code == 200:
         return response.json().get("data", [])
@@ -102,25 +143,69 @@ def get_bulk_attendance(date: str, auth) -> list:
         raise UnknownResponseError(f"Failed to fetch bulk attendance data for date {date}: {response.text}")
 
 
-def bulk_submit(records: list, ids: list=[]) -> requests.Response:
+day_states = {}  # The attendance of each user per day ('YYYY-MM-DD' -> {user_id: attendance}), fetched once per run
+
+
+def prefetch_days(dates: list, auth, cache: dict=None) -> dict:
     """
-    Sends a bulk request to the laravel API to process attendance records.
+    Fetches the attendance of every user for each of the given days, skipping the days
+    already in the cache. The days are fetched concurrently.
 
-    :param records: A list of attendance records to be processed
-    :param attendances: A list of attendance records to be checked against
-    :return: The response from the API
+    :param dates: A list of dates (format: 'YYYY-MM-DD')
+    :param auth: A dictionary containing authentication details (access token)
+    :param cache: The map to fill (defaults to the module-wide day_states map)
+    :return: The filled map
+    """
+    cache = day_states if cache is None else cache
+    missing = sorted(set(dates) - set(cache))
+    if missing:
+        with metrics.time('prefetch', transport='laravel'), ThreadPoolExecutor(max_workers=max(1, min(len(missing), prefetch_workers))) as executor:
+            results = list(executor.map(lambda date: get_bulk_attendance(date, auth), missing))
+
+        for date, attendances in zip(missing, results):
+            cache[date] = {int(att['user_id']): att for att in attendances}
+
+    return cache
+
+
+def previous_day(day: str) -> str:
+    """
+    Gives the day before a date.
+
+    :param day: A date (format: 'YYYY-MM-DD')
+    :return: The date of the day before
+    """
+    return (datetime.strptime(day, '%Y-%m-%d') - timedelta(days=1)).strftime('%Y-%m-%d')
+
+
+def bulk_submit(records: list, ids: list=[], state: dict=None) -> list:
+    """
+    Sends a bulk request to the laravel API to process attendance records.
+    The records are checked against the attendance of their own day, and the
+    decisions made for a day are carried forward to the later records of that day.
+    A user without attendance on a day starts from their final state on the day
+    before, so that an attendance left open overnight (a night shift) is closed.
+
+    :param records: A list of attendance records to be processed, oldest first
+    :param ids: A list of attendance device IDs to process
+    :param state: An optional per-day attendance map, kept between calls when importing in batches
+    :return: The positions in `records` of the records that could not be processed
     """
     auth = load_storage()
-    if not auth or 'access_token' not in auth:
-        auth = try_auth()
 
     headers = { 'Authorization': f"Bearer {auth['access_token']}", **default_headers }
 
     url = f"{api_url}{urls['bulk_submit']}?business_id={business_id}"
-    last_attendances = get_bulk_attendance(records[-1].get('timestamp').strftime('%Y-%m-%d'), auth)
-    last_attendances_dict = {int(att['user_id']): att for att in last_attendances}
+    ids = set(ids)
+    days = [
+        (record['timestamp'] if isinstance(record['timestamp'], datetime) else time_str(record['timestamp'])).strftime('%Y-%m-%d')
+        for record in records
+    ]
+    wanted = { day for day, record in zip(days, records) if str(record.get('attendance_device_id')) in ids }
+    day_attendances = prefetch_days(sorted(wanted | { previous_day(day) for day in wanted }), auth, state)
     collected = []
-    for record in records:
+    failed = []
+    for i, (day, record) in enumerate(zip(days, records)):
         if str(record.get('attendance_device_id')) not in ids:
             continue
 
@@ -128,30 +213,114 @@ def bulk_submit(records: list, ids: list=[]) -> requests.Response:
         try:
             record['attendance_device_id'] = str(record.get('attendance_device_id'))
             if record.get('_id'): del record['_id']
-            record['timestamp'] = time_str(record.get('timestamp'), True)
-            res = decide(record, False, last_attendances_dict.get(sep, None))
+            record['timestamp'] = time_str(record.get('timestamp'), True) if isinstance(record['timestamp'], datetime) else record['timestamp']
+            last = day_attendances[day].get(sep) or day_attendances[previous_day(day)].get(sep, {})
+            res = decide(record, False, last)
             if res:
                 collected.append(res)
-                if sep not in last_attendances_dict:
-                    last_attendances_dict[sep] = res
-                else:
-                    last_attendances_dict[sep].update(res)
+                day_attendances[day][sep] = res  # The decision replaces the previous state (format_data no longer strips it in place)
 
         except Exception as error:
+            failed.append(i)
             logger.error(f'Error processing record {sep}: {error}')
 
     if len(collected) == 0:
-        return requests.Response()
+        return failed
 
-    response = requests.post(url, json={ "bulk_data": collected }, headers=headers)
+    # Write the attendances to the outbox first, if the request fails they are retried from there
+    queued = [(queued_kind(res), res, attendance_key(queued_kind(res), res)) for res in collected]
+    fresh = outbox.enqueue(queued)
+    if fresh is not None:
+        collected = [res for _, res, key in queued if key in fresh]
+        if len(collected) == 0:
+            return failed
 
-    if response.status_code == 200:
+    try:
+        with metrics.time('submit', transport='laravel', mode='bulk'):
+            response = http_client.post(url, json={ "bulk_data": collected }, headers=headers)
+        error = None if response.status_code == 200 else response.text
+    except requests.RequestException as e:
+        error = str(e)
+
+    if error is None:
+        metrics.inc('submissions', len(collected), transport='laravel', outcome='sent', mode='bulk')
         logger.debug(response.json())
-        return response
+        latest = { str(res.get('user_id')): res for res in collected }
+        for res in latest.values():
+            record_state(res)
+        if fresh is not None:
+            outbox.mark_sent([key for _, _, key in queued if key in fresh])
+        return failed
+
+    elif fresh is not None:
+        logger.warning(f"Failed to send bulk attendance records, {len(collected)} left in the outbox to be retried: {error}")
+        return failed
+
     else:
-        raise UnknownResponseError(f"Failed to send bulk attendance records: {response.text}")
+        raise UnknownResponseError(f"Failed to send bulk attendance records: {error}")
+
+
+def fetch_state() -> list:
+    """
+    Fetches today's attendance of every user, for reconciling the local check-in state.
+
+    :return: A list of dictionaries with the employee, time (datetime) and log_type of the last punches
+    """
+    auth = load_storage()
+
+    states = []
+    for att in get_bulk_attendance(datetime.now().strftime('%Y-%m-%d'), auth):
+        if att.get('clock_out_time'):
+            states.append({ "employee": str(att['user_id']), "time": time_str(att['clock_out_time']), "log_type": "OUT" })
+        elif att.get('clock_in_time'):
+            states.append({ "employee": str(att['user_id']), "time": time_str(att['clock_in_time']), "log_type": "IN" })
+
+    return states
+
 
+def stored_attendance(uid, rt: datetime) -> dict | None:
+    """
+    Builds the attendance of a user on the day of a punch from the local check-in state.
+
+    :param uid: The user identifier
+    :param rt: The time of the punch
+    :return: The attendance in the laravel format, or None if the local state cannot tell
+    """
+    entry = checkin_state.get(str(uid))
+    if not entry:
+        return None
+
+    if entry['time'].date() == rt.date():
+        key = 'clock_out_time' if entry.get('log_type') == 'OUT' else 'clock_in_time'
+        return { key: time_str(entry['time'], True) }
+
+    return {} if entry['time'] < rt else None  # Nothing recorded yet on the day of a newer punch
+
+
+def record_state(data: dict):
+    """
+    Stores the punch of a successful clock-in or clock-out in the local check-in state.
+
+    :param data: The clock-in or clock-out data that was submitted
+    """
+    if data.get('clock_out_time'):
+        checkin_state.record(str(data.get('user_id')), time_str(data['clock_out_time']), 'OUT')
+    elif data.get('clock_in_time'):
+        checkin_state.record(str(data.get('user_id')), time_str(data['clock_in_time']), 'IN')
+
+
+def drop_state(kind: str, payload: dict):
+    """
+    Forgets the check-in state of a user whose attendance was dead-lettered, the
+    state was built from an attendance the laravel API never received.
+
+    :param kind: 'clock_in' or 'clock_out'
+    :param payload: The decided attendance
+    """
+    checkin_state.forget(str(payload.get('user_id')))
 
+
+@metrics.timed('decide', transport='laravel')
 def decide(data, submit=True, last=None) -> requests.Response:
     """
     Logic to handle check-in/check-out based on the provided data.
@@ -162,12 +331,12 @@ def decide(data, submit=True, last=None) -> requests.Response:
     """
     auth = load_storage()
 
-    if not auth:
-        auth = try_auth()
-
     d = format_data(data)
     rt = time_str(d.get('timestamp'))
-    attendance = format_data(get_attendance(d.get('user_id', data.get('attendance_device_id')), auth) if not last else last, True)
+    uid = d.get('user_id', data.get('attendance_device_id'))
+    if last is None:
+        last = stored_attendance(uid, rt)
+    attendance = format_data(get_attendance(uid, auth) if last is None else last, True)
 
     prev = attendance.get('check_out', None)
     if prev:
@@ -176,7 +345,7 @@ def decide(data, submit=True, last=None) -> requests.Response:
             return requests.Response() if submit else None
 
         else:
-            return clock_in(d, auth, submit)
+            kind = 'clock_in'
 
     else:
         prev = attendance.get('check_in')
@@ -185,10 +354,67 @@ def decide(data, submit=True, last=None) -> requests.Response:
             if rt <= time:
                 return requests.Response() if submit else None
             else:
-                return clock_out(d, auth, submit)
+                kind = 'clock_out'
 
         else:
-            return clock_in(d, auth, submit)
+            kind = 'clock_in'
+
+    payload = (clock_in if kind == 'clock_in' else clock_out)(d, auth, False)
+    if not submit:
+        return payload
+
+    # The state is recorded by clock_in/clock_out from what they actually sent, which may
+    # differ from the payload (an "Already clocked in" answer turns a clock-in into a clock-out)
+    return outbox.submit(kind, payload, attendance_key(kind, payload))
+
+
+def queued_kind(data: dict) -> str:
+    """
+    Tells whether a decided attendance is a clock-in or a clock-out.
+
+    :param data: The decided attendance
+    :return: 'clock_in' or 'clock_out'
+    """
+    return 'clock_out' if data.get('clock_out_time') else 'clock_in'
+
+
+def attendance_key(kind: str, data: dict) -> str:
+    """
+    Builds the idempotency key of a decided attendance, a punch is only ever queued once.
+
+    :param kind: 'clock_in' or 'clock_out'
+    :param data: The decided attendance
+    :return: The idempotency key
+    """
+    return f"{data.get('user_id')}:{kind}:{data.get(kind + '_time')}"
+
+
+def send_queued(kind: str, payload: dict, attempts: int) -> requests.Response | None:
+    """
+    Sends a decided attendance from the outbox. A retried clock-in is only sent if the
+    earlier attempt did not reach the laravel API, otherwise the API would answer
+    "Already clocked in" and the punch would be turned into a clock-out.
+
+    :param kind: 'clock_in' or 'clock_out'
+    :param payload: The decided attendance
+    :param attempts: The number of earlier failed attempts
+    :return: The response from the API, or None if the clock-in was already there
+    """
+    auth = load_storage()
+
+    if kind == 'clock_out':
+        return clock_out(payload, auth)
+
+    if attempts:
+        try:
+            current = get_attendance(payload.get('user_id'), auth).get('clock_in_time')
+        except requests.RequestException as e:
+            raise NetworkError(f"Network error occurred while fetching attendance: {str(e)}")
+
+        if current and time_str(current) == time_str(payload['clock_in_time']):
+            return None
+
+    return clock_in(payload, auth)
 
 
 def clock_in(data, auth, submit=True) -> requests.Response:
@@ -212,18 +438,19 @@ def clock_in(data, auth, submit=True) -> requests.Response:
             if not submit:
                 return data
 
-        else:
+        elif not data.get('clock_in_time'):
             raise ValueError("Timestamp is required for clock-in data.")
 
         url = f"{api_url}{urls['clockin']}?business_id={business_id}"
 
-        response = requests.post(url, json=data, headers=headers)
+        response = http_client.post(url, json=data, headers=headers)
 
         if response.status_code == 200:
+            record_state(data)
             return response
         else:
             if response.status_code == 400 and "Already clocked in" in response.text:
-                del data['clock_in_note']
+                data.pop('clock_in_note', None)
                 data['check_out'] = data.pop('clock_in_time')
                 data['clock_out_note'] = "Automatically clocked out using biometric device"
 
@@ -258,17 +485,32 @@ def clock_out(data, auth, submit=True) -> requests.Response:
             if not submit:
                 return data
 
-        else:
+        elif not data.get('clock_out_time'):
             raise ValueError("Timestamp is required for clock-out data.")
 
         url = f"{api_url}{urls['clockout']}?business_id={business_id}"
 
-        response = requests.post(url, json=data, headers=headers)
+        response = http_client.post(url, json=data, headers=headers)
 
         if response.status_code == 200:
+            record_state(data)
             return response
         else:
             raise UnknownResponseError(f"Failed to clock out: {response.text}")
 
     except requests.RequestException as e:
         raise NetworkError(f"Network error occurred while clocking out: {str(e)}")
+
+
+def reset():
+    """
+    Forgets the state cached in memory during a run, so that a long-running
+    process starts every cycle from the stored check-in state.
+    """
+    day_states.clear()
+    checkin_state.cache.clear()
+
+
+directory = create_directory('laravel', fetch_directory)
+checkin_state = create_state('laravel', fetch_state)
+outbox = create_outbox('laravel', send_queued, on_dead=drop_state)
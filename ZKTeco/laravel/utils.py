@@ -1,9 +1,11 @@
-import requests
+import threading
 from datetime import datetime, timedelta
 from laravel.config import api_url, client_id, client_secret, username, password
 from laravel.exceptions import AuthenticationError, NetworkError, TokenRefreshError, LoginError
+from laravel.mapping import fields
 from db import db
 from logger import logger
+from http_client import http_client
 
 default_headers = {
     'Content-Type': 'application/json',
@@ -11,6 +13,42 @@ default_headers = {
     'User-Agent': 'Mozilla/5.0 (compatible; laravelBot/1.0; +https://laravel.com)'
 }
 
+TOKEN_ID = 'laravel'  # The single document in the auth collection that holds the token
+
+
+def save_token(storage_data: dict) -> dict:
+    """
+    Stores the authentication data in the single token document of the auth collection.
+
+    :param storage_data: The authentication data to store
+    :return: The stored authentication data
+    """
+    client = db.get_db('auth')
+    if client is None:
+        raise NetworkError("Database connection failed. Cannot store authentication data.")
+
+    storage_data['_id'] = TOKEN_ID
+    result = client.replace_one({ '_id': TOKEN_ID }, storage_data, upsert=True)
+    if not result.acknowledged:
+        raise NetworkError("Failed to store authentication data in the database.")
+
+    client.delete_many({ '_id': { '$ne': TOKEN_ID } })  # Tokens inserted by earlier versions, one per login
+    return storage_data
+
+
+def stored_token() -> dict:
+    """
+    Loads the stored authentication data from the database.
+
+    :return: The authentication data, or None if there is none
+    """
+    client = db.get_db('auth')
+    if client is None:
+        raise NetworkError("Database connection failed. Cannot load storage data.")
+
+    return client.find_one({ '_id': TOKEN_ID }) or client.find_one({}, sort=[('expires_in', -1)])
+
+
 def login_to_laravel() -> dict:
     """
     Logs in to the laravel API and returns the access token.
@@ -19,7 +57,7 @@ def login_to_laravel() -> dict:
     :param password: The password for laravel API
     :param client_secret: The client secret for laravel API
     :param client_id: The client ID for laravel API
-    :return: Access token if login is successful, None otherwise (stores the bearer token in JSON file, with its expiry time)
+    :return: Access token if login is successful, None otherwise (stores the bearer token in the database, with its expiry time)
     """
     url = f"{api_url}/oauth/token"
     payload = {
@@ -30,45 +68,33 @@ def login_to_laravel() -> dict:
         "password": password
     }
 
-    response = requests.post(url, json=payload, headers=default_headers)
+    response = http_client.post(url, json=payload, headers=default_headers)
 
     if response.status_code == 200:
-        client = db.get_db('auth')
-        if client is None:
-            raise NetworkError("Database connection failed. Cannot store authentication data.")
-
         storage_data = {}
         storage_data['access_token'] = response.json().get('access_token')
         storage_data['expires_in'] = timedelta(seconds=response.json().get('expires_in') - 3600) + datetime.now()
         storage_data['token_type'] = response.json().get('token_type', 'Bearer')
         storage_data['refresh_token'] = response.json().get('refresh_token', None)
 
-        result = client.insert_one(storage_data)
-        if result.acknowledged:
-            logger.log("Login successful. Access token stored in database.", 'SUCCESS')
-            return storage_data
-        else:
-            raise NetworkError("Failed to store authentication data in the database.")
+        save_token(storage_data)
+        logger.log("Login successful. Access token stored in database.", 'SUCCESS')
+        return storage_data
 
     else:
         raise LoginError(f"Login failed: {response.status_code} - {response.text}")
 
 
-def refresh_token() -> dict:
+def refresh_token(storage_data: dict=None) -> dict:
     """
     Refreshes the access token using the refresh token.
     
-    :param client_id: The client ID for laravel API
-    :param client_secret: The client secret for laravel API
+    :param storage_data: The authentication data holding the refresh token (defaults to the stored one)
     :return: New access token if refresh is successful, None otherwise
     """
-    client = db.get_db('auth')
-    if client is None:
-        raise NetworkError("Database connection failed. Cannot refresh token.")
-
-    storage_data = client.find_one({})
+    storage_data = storage_data or token_manager.token or stored_token()
 
-    if not storage_data or 'refresh_token' not in storage_data:
+    if not storage_data or not storage_data.get('refresh_token'):
         raise AuthenticationError("Refresh token is missing. Please login again.")
 
     refresh_token = storage_data.get('refresh_token')
@@ -81,105 +107,154 @@ def refresh_token() -> dict:
         'refresh_token': refresh_token
     }
 
-    response = requests.post(url, data=payload, headers=default_headers)
+    response = http_client.post(url, data=payload, headers=default_headers)
 
     if response.status_code == 200:
         response = response.json()
+        storage_data = {}
         storage_data['access_token'] = response.get('access_token')
         storage_data['expires_in'] = timedelta(seconds=response.get('expires_in') - 3600) + datetime.now()
         storage_data['token_type'] = response.get('token_type', 'Bearer')
-        storage_data['refresh_token'] = response.get('refresh_token', None)
-        
-        result = client.update_one({ storage_data['_id'] }, { '$set': storage_data })
-        if result.modified_count > 0:
-            logger.log("Token refreshed successfully. New access token stored in database.", 'SUCCESS')
-            return storage_data
-        else:
-            raise TokenRefreshError("Failed to update access token in the database.")
+        storage_data['refresh_token'] = response.get('refresh_token', refresh_token)
+
+        try:
+            save_token(storage_data)
+        except NetworkError as e:
+            raise TokenRefreshError(f"Failed to update access token in the database: {e}")
+
+        logger.log("Token refreshed successfully. New access token stored in database.", 'SUCCESS')
+        return storage_data
 
     else:
         raise TokenRefreshError(f"Token refresh failed: {response.status_code} - {response.text}")
 
 
-def try_auth() -> dict:
+def try_auth(storage_data: dict=None) -> dict:
     """
     Attempts to authenticate with the laravel API and returns the authentication data.
+    Use token_manager.get() instead, which makes sure only one worker authenticates at a time.
 
+    :param storage_data: The authentication data holding the refresh token (defaults to the stored one)
     :return: A dictionary containing authentication data
     """
     try:
-        return refresh_token()
+        return refresh_token(storage_data)
     except (AuthenticationError, TokenRefreshError) as e:
         logger.log(f"Authentication error: {e}", 'ERROR')
         logger.log("Attempting to login to laravel...", 'INFO')
         return login_to_laravel()
-    
+
+
+class TokenManager:
+    """
+    Keeps the laravel access token in memory until it expires and refreshes it
+    in the background shortly before that. However many workers ask for a token
+    at the same time, at most one refresh is in flight.
+    """
+    def __init__(self):
+        """
+        Initialize the TokenManager class.
+        """
+        self.token = None
+        self.lock = threading.Lock()
+        self.timer = None
+
+    def valid(self, token) -> bool:
+        """
+        Whether a token is present and has not expired.
+
+        :param token: The authentication data
+        """
+        return bool(token and token.get('access_token') and datetime.now() < token.get('expires_in', datetime.min))
+
+    def get(self) -> dict:
+        """
+        Returns a valid token, loading or refreshing it only if the cached one has expired.
+
+        :return: A dictionary containing authentication data
+        """
+        token = self.token
+        if self.valid(token):
+            return token
+
+        return self.refresh(token)
+
+    def refresh(self, stale=None) -> dict:
+        """
+        Replaces a token that is expired or was rejected, with at most one refresh in flight:
+        workers waiting on the lock get the token the first one obtained. This is the only
+        place where the token is refreshed; errors are raised to the caller.
+
+        :param stale: The token the caller found unusable (None if there was none)
+        :return: A dictionary containing authentication data
+        """
+        with self.lock:
+            if self.token is not stale and self.valid(self.token):  # Another worker refreshed it while we waited
+                return self.token
+
+            stored = stored_token()
+            if self.valid(stored) and (not stale or stored.get('access_token') != stale.get('access_token')):
+                self.token = stored  # Refreshed by another process
+            else:
+                if stored:
+                    logger.log("Access token has expired. Refreshing token...", 'INFO')
+                self.token = try_auth(stored)
+
+            self.schedule()
+            return self.token
+
+    def schedule(self):
+        """
+        Schedules a background refresh for when the current token expires.
+        """
+        if self.timer:
+            self.timer.cancel()
+
+        delay = (self.token['expires_in'] - datetime.now()).total_seconds() if self.token else 0
+        self.timer = threading.Timer(max(delay, 1), self.renew)
+        self.timer.daemon = True
+        self.timer.start()
+
+    def renew(self):
+        """
+        Refreshes the token ahead of its expiry. Runs on the background timer.
+        """
+        try:
+            self.refresh(self.token)
+        except Exception as e:
+            logger.log(f"Background token refresh failed: {e}", 'ERROR')
+            self.token = None  # The next get() will retry
+
+    def stop(self):
+        """
+        Cancels the scheduled background refresh.
+        """
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+
+
+token_manager = TokenManager()
+
 
 def load_storage() -> dict:
     """
-    Loads the storage data from the JSON file.
+    Loads the authentication data from the token manager, authenticating if needed.
+    Authentication errors are raised to the caller.
     
     :return: Storage data as a dictionary
     """
-
-    try:
-        client = db.get_db('auth')
-        if client is None:
-            raise NetworkError("Database connection failed. Cannot load storage data.")
-
-        storage_data = client.find_one({})
-        if storage_data:
-            if 'expires_in' in storage_data and datetime.now() >= storage_data['expires_in']:
-                logger.log("Access token has expired. Refreshing token...", 'INFO')
-                storage_data = try_auth()
-
-            return storage_data
-        else:
-            return try_auth()
-
-    except Exception as e:
-        logger.log(f"Error loading storage data: {e}", 'ERROR')
-        return {}
+    return token_manager.get()
 
 
 def format_data(data: dict={}, reverse: bool=False, keeps: list=None) -> dict:
     """
     Formats the data to match the laravel API requirements.
+    The input is left untouched; see laravel.mapping for the field map.
 
     :param data: The data to be formatted
     :param reverse: If True, reverses the formatting (from laravel to Attendance Algorithm API format)
     :param keeps: List of required fields to keep in the formatted data
     :return dict: Formatted data as a dictionary
     """
-
-    expects = [ "employee", "employee_name", "attendance_date", "company", "check_in", "check_out", "status", "attendance_device_id", "default_shift", "device" ]
-    answers = [ "id", "first_name+last_name", "date", "business_id", "clock_in_time", "clock_out_time", "status", "user_id", "essentials_shift_id", "ip_address" ]
-
-    formatted_data = {}
-    query = expects if not reverse else answers
-    reply = answers if not reverse else expects
-
-    for key in query:
-        if key in data:
-            if '+' not in reply[query.index(key)]:
-                formatted_data[reply[query.index(key)]] = data[key]
-            else:
-                keys = reply[query.index(key)].split('+')
-                values = data.get(key, '').strip().split(' ')
-                if len(values) == len(keys):
-                    formatted_data[keys[0]], formatted_data[keys[1]] = values[0], values[1]
-
-        else:
-            keys = key.split('+')
-            if len(keys) > 1:
-                vals = [data.get(k, '') for k in keys]
-                vals = [v for v in vals if v is not None]
-
-                formatted_data[reply[query.index(key)]] = ' '.join(vals).strip() if all(vals) else None
-                if not formatted_data[reply[query.index(key)]]: del formatted_data[reply[query.index(key)]]
-
-        if key in data: del data[key]
-
-    res = {**data, **formatted_data}
-
-    return {k: res[k] for k in keeps if k in res} if keeps else res
+    return fields.convert(data, reverse, keeps)
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+
+import signal
+import threading
+import time
+from exec import Session
+from bio_config import devices, live, puller
+from db import db
+from logger import logger
+from puller import polled, pull_device
+
+
+class LiveCapture(threading.Thread):
+    """
+    Holds a live capture subscription on one device and stores every punch as it arrives.
+
+    When the subscription is lost it reconnects with exponential backoff. Punches made
+    while it was not subscribed are picked up with a batch pull before subscribing again.
+    After an idle renewal that pull is incremental (watermark-based) and never clears the
+    device, so renewing does not put the load of a full pull on the terminal.
+    """
+    def __init__(self, device, on_punch=None, timeout=10, idle=300, backoff=5, max_backoff=300):
+        """
+        Initialize the LiveCapture class.
+
+        :param device: The device configuration dictionary
+        :param on_punch: An optional function called after punches have been stored
+        :param timeout: The number of seconds to wait for a punch before checking whether to stop
+        :param idle: The number of seconds without a punch after which the subscription is renewed
+        :param backoff: The base number of seconds between reconnection attempts
+        :param max_backoff: The longest wait between reconnection attempts, in seconds
+        """
+        super().__init__(name=f"live-{device.get('ip')}", daemon=True)
+        self.device = device
+        self.on_punch = on_punch
+        self.timeout = timeout
+        self.idle = idle
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.stopping = threading.Event()
+
+    def stop(self):
+        """
+        Asks the subscription to end after its current wait.
+        """
+        self.stopping.set()
+
+    def run(self):
+        name = self.device.get('name')
+        failures = 0
+        gap, renewed = True, False  # Nothing has been captured yet, so catch up with a batch pull first
+        while not self.stopping.is_set():
+            try:
+                if gap:
+                    summary = pull_device(self.device, incremental=renewed or puller.get('incremental', False))
+                    if summary["status"] not in ('ok', 'empty'):
+                        raise ConnectionError(summary["error"])
+                    if summary["records"] and self.on_punch:
+                        self.on_punch()
+                    gap = renewed = False
+
+                self.capture()
+                failures = 0
+                gap = renewed = True  # Punches made while re-subscribing are not captured
+
+            except Exception as e:
+                failures += 1
+                gap, renewed = True, False
+                delay = min(self.max_backoff, self.backoff * 2 ** (failures - 1))
+                logger.warning(f"Live capture of device {name} lost, reconnecting in {delay}s: {e}")
+                self.stopping.wait(delay)
+
+    def capture(self):
+        """
+        Subscribes to the device until it is stopped or has been idle for too long.
+        """
+        session = Session(self.device)
+        try:
+            last = time.monotonic()
+            logger.info(f"Live capture started on device: {self.device.get('name')}")
+            for attendance in session.capture(self.timeout):
+                if attendance is not None:
+                    last = time.monotonic()
+                    self.store(attendance)
+
+                elif self.stopping.is_set() or time.monotonic() - last > self.idle:
+                    session.stop_capture()  # Ends the subscription after this wait, an idle one is renewed
+
+        finally:
+            session.close()
+
+    def store(self, attendance):
+        """
+        Stores a captured punch in the database.
+
+        :param attendance: The pyzk Attendance object of the punch
+        """
+        record = {
+            "attendance_device_id": attendance.user_id, "timestamp": attendance.timestamp,
+            "status": attendance.status, "punch": attendance.punch, "device": self.device.get('ip')
+        }
+        if db.upsert_records([record]) is None:
+            raise ConnectionError("Record could not be stored")
+
+        logger.info(f"Captured punch of {attendance.user_id} at {attendance.timestamp} on device: {self.device.get('name')}")
+        if self.on_punch:
+            self.on_punch()
+
+
+def start_all(devices, on_punch=None):
+    """
+    Starts a live capture on every device, using the settings from bio_config.
+
+    :param devices: A list of device configuration dictionaries
+    :param on_punch: An optional function called after punches have been stored
+    :return: The list of started LiveCapture threads
+    """
+    captures = [
+        LiveCapture(
+            device, on_punch,
+            timeout=live.get('timeout', 10),
+            idle=live.get('idle', 300),
+            backoff=live.get('backoff', 5),
+            max_backoff=live.get('max_backoff', 300)
+        )
+        for device in devices
+    ]
+    for capture in captures:
+        capture.start()
+
+    return captures
+
+
+def stop_all(captures):
+    """
+    Stops the live captures and waits for them to end.
+
+    :param captures: The LiveCapture threads returned by start_all
+    """
+    for capture in captures:
+        capture.stop()
+
+    for capture in captures:
+        capture.join(capture.timeout * 2)
+
+
+if __name__ == "__main__":
+    if not devices:
+        logger.error('Please fill in the necessary details in bio_config.py before running the script')
+        exit(1)
+
+    stopping = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.set())
+    signal.signal(signal.SIGINT, lambda signum, frame: stopping.set())
+
+    captures = start_all(polled(devices))
+    while not stopping.wait(1):
+        pass
+
+    logger.info("Stopping live captures...")
+    stop_all(captures)
+    db.close_connection()
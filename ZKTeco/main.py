@@ -9,11 +9,19 @@
 '''
 
 import sys
+import time
+import asyncio
 import importlib
 from logger import logger
-from datetime import datetime, timedelta
-from bio_config import devices
+from datetime import datetime
+from bio_config import devices, importer, sync
 from db import db
+from http_client import http_client
+from metrics import metrics
+import profiling
+
+profiler = None  # Set when main.py runs with --profile or --trace-memory
+
 
 def handleExit(code=0):
     if (code != 0):
@@ -21,7 +29,11 @@ def handleExit(code=0):
     else:
         logger.info('MGS graceful exit. Shutting down. Please wait...')
 
+    if profiler:
+        profiler.stop()
+    metrics.export('main')
     db.close_connection()
+    http_client.close()
     exit(code)
 
 
@@ -31,76 +43,140 @@ def gISOl(date):
 
 supported_erps = {'Laravel', 'ERPNext' }
 
-if '-m' in sys.argv or '--module' in sys.argv:
-    try:
-        module_index = sys.argv.index('-m') if '-m' in sys.argv else sys.argv.index('--module')
-        module_name = sys.argv[module_index + 1]
-        if module_name not in supported_erps:
-            raise ValueError(f"Unsupported module: {module_name}. Supported modules are: {', '.join(supported_erps)}")
-
-        else:
-            module = importlib.import_module(module_name.lower())
-
-    except (IndexError, ValueError, ImportError) as e:
-        logger.error(f"Error loading module: {e}")
-        handleExit(1)
 
-else:
-    print(f"Usage: {sys.argv[0]} -m <module_name> [options]")
-    print(f"Please specify a module to run the script. Supported modules:\n\t{'\n\t'.join(supported_erps)}")
-    exit(1)
-
-
-def run_attendance():
+def load_module(module_name):
+    """
+    Imports the transport package of an ERP.
+
+    :param module_name: The name of the ERP (case-insensitive, e.g. 'ERPNext' or 'erpnext')
+    :return: The imported package
+    """
+    matches = [erp for erp in supported_erps if erp.lower() == str(module_name).lower()]
+    if not matches:
+        raise ValueError(f"Unsupported module: {module_name}. Supported modules are: {', '.join(supported_erps)}")
+
+    return importlib.import_module(matches[0].lower())
+
+
+def load_employees(module):
+    """
+    Loads the employees from the ERP directory and reconciles their check-in state.
+
+    :param module: The ERP transport package
+    :return: The list of attendance device IDs of the employees
+    """
+    employeesData = module.transport.directory.employees()
+    if not employeesData or len(employeesData) == 0:
+        raise ValueError('No employees found. Please check the configuration and try again.')
+
+    ids = [ d.get('attendance_device_id') for d in employeesData ]
+    module.transport.checkin_state.reconcile()
+    logger.info(f'Employees before filtering: {len(employeesData)}')
+    employees = [employee for employee in employeesData if employee.get("employee")]
+    logger.info(f'Employees after filtering: {len(employees)}')
+    return ids
+
+
+def import_attendance(module, ids, records=None, state=None, bulk=False, latest=False, use_async=False):
+    """
+    Sends attendance records to the ERP and marks the ones that were handled as delivered.
+
+    :param module: The ERP transport package
+    :param ids: The attendance device IDs of the employees
+    :param records: The records to send (defaults to the undelivered records, or the latest ones with `latest`)
+    :param state: The per-employee state carried from one batch to the next when importing in batches
+    :param bulk: Use the bulk submit endpoint of the ERP
+    :param latest: Send the latest record of each employee instead of the undelivered ones
+    :param use_async: Decide and submit the records concurrently
+    """
+    if records is None:
+        records = db.collect_latest_records() if latest else db.collect_undelivered_records(ids=ids)
+
+    if not len(records):
+        return logger.info('No attendance records found.')
+    else:
+      logger.info(f'Found {len(records)} attendance records')
+      logger.info('Contacting ERP...')
+
+      keys = [ record.pop('_id', None) for record in records ]
+      if bulk:
+          failed = set(module.transport.bulk_submit(records, ids=ids, state=state))
+          return db.mark_delivered([ key for i, key in enumerate(keys) if i not in failed ])
+
+      if use_async:
+          aio = importlib.import_module(f'{module.__name__}.aio')
+          for record in records:
+              record['attendance_device_id'] = str(record.get('attendance_device_id'))
+              record['timestamp'] = gISOl(record.get('timestamp'))
+
+          results = asyncio.run(aio.decide_many(records, concurrency=sync.get('concurrency', 8)))
+          for record, res in zip(records, results):
+              if isinstance(res, Exception):
+                  logger.error(f'Error processing record {record.get("attendance_device_id")}: {res}')
+              else:
+                  logger.debug(f'Response from ERP: {res}')
+
+          return db.mark_delivered([ key for key, res in zip(keys, results) if not isinstance(res, Exception) ])
+
+      if hasattr(module.transport, 'prefetch'):
+          module.transport.prefetch([ module.transport.directory.lookup(r.get('attendance_device_id')) for r in records ])
+
+      for key, record in zip(keys, records):
+          try:
+              record['attendance_device_id'] = str(record.get('attendance_device_id'))
+              record['timestamp'] = gISOl(record.get('timestamp'))
+              res = module.transport.decide(record)
+              logger.info(f'Response from ERP: {res}')
+              db.mark_delivered([key])
+
+          except Exception as error:
+              logger.error(f'Error processing record {record.get("attendance_device_id")}: {error}')
+
+
+def import_range(module, ids, from_date, to_date, batch_size=None, bulk=False, use_async=False):
+    """
+    Sends every record between two dates to the ERP, streaming them from the database in batches.
+
+    :param module: The ERP transport package
+    :param ids: The attendance device IDs of the employees
+    :param from_date: The first day to import (datetime)
+    :param to_date: The last day to import (datetime)
+    :param batch_size: The number of records per batch (defaults to importer.batch_size)
+    :param bulk: Use the bulk submit endpoint of the ERP
+    :param use_async: Decide and submit the records concurrently
+    """
+    from_date = from_date.replace(hour=0, minute=30, second=0, microsecond=0)
+    to_date = to_date.replace(hour=23, minute=59, second=59, microsecond=999999)
+    batch_size = batch_size or importer.get('batch_size', 500)
+
+    logger.info(f'Importing records from {from_date} to {to_date} in batches of {batch_size}')
+    filters = {'timestamp': {'$gte': from_date, '$lte': to_date}, 'attendance_device_id': {'$in': ids}}
+    state = {}  # Per-employee last state, carried from one batch to the next
+    for batch in db.stream_filtered_records(filters=filters, batch_size=batch_size):
+        import_attendance(module, ids, records=batch, state=state, bulk=bulk, use_async=use_async)
+        if importer.get('pause'):
+            time.sleep(importer.get('pause'))
+
+
+def run_attendance(module):
   try:
       if not devices:
         logger.error('Please fill in the necessary details in bio_config.py before running the script')
         handleExit(1)
 
-      fields = ["employee", "employee_name", "attendance_date", "company", "check_in", "check_out", "status", "attendance_device_id", "default_shift"]
-      filters = {}
       is_import = '--import' in sys.argv
+      options = {
+          "bulk": "--use-bulk" in sys.argv or "-b" in sys.argv,
+          "use_async": "--async" in sys.argv,
+      }
 
-      employeesData = module.transport.get_users(filters=filters, fields=fields)
-      if not employeesData or len(employeesData) == 0:
-          logger.error('No employees found. Please check the configuration and try again.')
-          handleExit(1)
-
-      ids = [ str(d.get('employee')) for d in employeesData ]
-      logger.info(f'Employees before filtering: {len(employeesData)}')
-      employees = [employee for employee in employeesData if employee.get("employee")]
-      logger.info(f'Employees after filtering: {len(employees)}')
+      ids = load_employees(module)
+      module.transport.outbox.drain()  # Retry the submissions that failed earlier before deciding new ones
 
       now = datetime.now()
       logger.info(f'Current time: {now}')
-
-      def import_attendance(filters=None):
-          records = db.collect_filtered_records(filters=filters) if filters else db.collect_latest_records()
-          if not len(records):
-              return logger.info('No attendance records found.')
-          else:
-            logger.info(f'Found {len(records)} attendance records')
-            logger.info('Contacting ERP...')
-
-            if "--use-bulk" in sys.argv or "-b" in sys.argv:
-                return module.transport.bulk_submit(records, ids=ids)
-
-            for record in records:
-                try:
-                    record['attendance_device_id'] = str(record.get('attendance_device_id'))
-                    if record.get('_id'):
-                        del record['_id']
-
-                    record['timestamp'] = gISOl(record.get('timestamp'))
-                    res = module.transport.decide(record)
-                    logger.info(f'Response from ERP: {res}')
-
-                except Exception as error:
-                    logger.error(f'Error processing record {record.get("attendance_device_id")}: {error}')
-
-      now = datetime.now()
       if not is_import:
-        import_attendance()
+        import_attendance(module, ids, latest='--latest' in sys.argv, **options)
 
       else:
         logger.info('Importing attendance records...')
@@ -114,20 +190,18 @@ def run_attendance():
                 logger.error('The "from" date must be earlier than the "to" date')
                 handleExit(1)
 
-            from_date = from_date.replace(hour=0, minute=30, second=0, microsecond=0)
-            to_date = to_date.replace(hour=23, minute=59, second=59, microsecond=999999)
+            batch_size = None
+            if '--batch-size' in sys.argv:
+                batch_size = int(sys.argv[sys.argv.index('--batch-size') + 1])
 
-            while from_date <= to_date:
-                to = from_date + timedelta(hours=1)
-                logger.info(f'Importing records from {from_date} to {to}')
-                filters = {'timestamp': {'$gte': from_date, '$lt': to}, 'attendance_device_id': {'$in': ids}}
-                import_attendance(filters=filters)
-                from_date = to
+            import_range(module, ids, from_date, to_date, batch_size=batch_size, **options)
 
         else:
             logger.error('Please provide the date range for import using --import <from_date> <to_date>')
             handleExit(1)
 
+      module.transport.outbox.drain()
+
       finish = (datetime.now() - now).total_seconds()
       logger.success('Attendance marking complete! Finished in ' + (f'{finish // 3600} hours, {(finish % 3600) // 60} minutes and {finish % 60} seconds' if finish > 3600 else f'{finish // 60} minutes and {finish % 60} seconds'))
       logger.success('Operation successful!')
@@ -139,5 +213,20 @@ def run_attendance():
 
 
 if __name__ == '__main__':
+    profiler = profiling.from_argv('main')
+    if '-m' in sys.argv or '--module' in sys.argv:
+        try:
+            module_index = sys.argv.index('-m') if '-m' in sys.argv else sys.argv.index('--module')
+            module = load_module(sys.argv[module_index + 1])
+
+        except (IndexError, ValueError, ImportError) as e:
+            logger.error(f"Error loading module: {e}")
+            handleExit(1)
+
+    else:
+        print(f"Usage: {sys.argv[0]} -m <module_name> [options] [--profile] [--trace-memory]")
+        print(f"Please specify a module to run the script. Supported modules:\n\t{'\n\t'.join(supported_erps)}")
+        exit(1)
+
     logger.info('All processes started')
-    run_attendance()
+    run_attendance(module)
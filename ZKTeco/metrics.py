@@ -0,0 +1,177 @@
+import os
+import socket
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from functools import wraps
+from bio_config import metrics as metrics_config
+from db import db
+from logger import logger
+
+
+class Metrics:
+    """
+    Counters and latency histograms of the pipeline stages, labelled by device or transport.
+
+    The stages are timed into a single `stage_seconds` histogram (stage="connect", "download",
+    "insert", "pull", "directory", "prefetch", "decide", "submit"), so that a regression in one stage
+    shows up next to the others. The metrics are kept in memory and written out by export(),
+    either as a Prometheus textfile or as a document in the `metrics` collection.
+    """
+    buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+    def __init__(self, prefix='biometrics'):
+        """
+        Initialize the Metrics class.
+
+        :param prefix: The prefix of the exported metric names
+        """
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+
+    @staticmethod
+    def key(name, labels):
+        return (name, tuple(sorted((k, str(v)) for k, v in labels.items() if v is not None)))
+
+    def inc(self, name, value=1, **labels):
+        """
+        Increments a counter.
+
+        :param name: The name of the counter (e.g. 'records_inserted')
+        :param value: The amount to add
+        :param labels: The labels of the counter (e.g. device='192.168.0.126')
+        """
+        key = self.key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, stage, seconds, **labels):
+        """
+        Records the duration of a stage in the `stage_seconds` histogram.
+
+        :param stage: The name of the stage (e.g. 'download')
+        :param seconds: The duration of the stage
+        :param labels: The labels of the observation (e.g. transport='erpnext')
+        """
+        key = self.key('stage_seconds', { "stage": stage, **labels })
+        with self.lock:
+            histogram = self.histograms.setdefault(key, { "buckets": [0] * len(self.buckets), "sum": 0.0, "count": 0 })
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    histogram["buckets"][i] += 1
+            histogram["sum"] += seconds
+            histogram["count"] += 1
+
+    @contextmanager
+    def time(self, stage, **labels):
+        """
+        Times the block it wraps as a stage. Failed blocks are counted in `stage_errors`.
+
+        :param stage: The name of the stage
+        :param labels: The labels of the observation
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            self.inc('stage_errors', stage=stage, **labels)
+            raise
+        finally:
+            self.observe(stage, time.perf_counter() - start, **labels)
+
+    def timed(self, stage, **labels):
+        """
+        Decorator timing every call of a function as a stage.
+
+        :param stage: The name of the stage
+        :param labels: The labels of the observation
+        """
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.time(stage, **labels):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def prometheus(self, job) -> str:
+        """
+        Renders the metrics in the Prometheus text format.
+
+        :param job: The name of the process exporting them (e.g. 'puller')
+        :return: The metrics as text
+        """
+        def render(labels, extra=()):
+            pairs = [("job", job), *labels, *extra]
+            return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}"
+
+        lines = []
+        with self.lock:
+            names = sorted({ name for name, _ in self.counters })
+            for name in names:
+                lines.append(f"# TYPE {self.prefix}_{name}_total counter")
+                for (n, labels), value in sorted(self.counters.items()):
+                    if n == name:
+                        lines.append(f"{self.prefix}_{name}_total{render(labels)} {value}")
+
+            if self.histograms:
+                lines.append(f"# TYPE {self.prefix}_stage_seconds histogram")
+            for (_, labels), histogram in sorted(self.histograms.items()):
+                for bound, count in zip(self.buckets, histogram["buckets"]):
+                    lines.append(f"{self.prefix}_stage_seconds_bucket{render(labels, [('le', bound)])} {count}")
+                lines.append(f"{self.prefix}_stage_seconds_bucket{render(labels, [('le', '+Inf')])} {histogram['count']}")
+                lines.append(f"{self.prefix}_stage_seconds_sum{render(labels)} {round(histogram['sum'], 6)}")
+                lines.append(f"{self.prefix}_stage_seconds_count{render(labels)} {histogram['count']}")
+
+        lines.append(f"# TYPE {self.prefix}_last_export_timestamp_seconds gauge")
+        lines.append(f"{self.prefix}_last_export_timestamp_seconds{render(())} {int(time.time())}")
+        return "\n".join(lines) + "\n"
+
+    def document(self, job) -> dict:
+        """
+        Builds the document stored in the `metrics` collection.
+
+        :param job: The name of the process exporting the metrics
+        :return: The metrics document
+        """
+        with self.lock:
+            return {
+                "job": job,
+                "host": socket.gethostname(),
+                "at": datetime.now(),
+                "counters": [{ "name": name, "labels": dict(labels), "value": value } for (name, labels), value in self.counters.items()],
+                "histograms": [
+                    { "name": name, "labels": dict(labels), "buckets": [[bound, count] for bound, count in zip(self.buckets, h["buckets"])], "sum": h["sum"], "count": h["count"] }
+                    for (name, labels), h in self.histograms.items()
+                ],
+            }
+
+    def export(self, job):
+        """
+        Writes the metrics out with the exporter configured in bio_config. Never raises,
+        a failing export must not fail the run it measures.
+
+        :param job: The name of the process exporting the metrics (e.g. 'puller', 'main', 'service')
+        """
+        exporter = metrics_config.get('exporter')
+        try:
+            if exporter == 'textfile':
+                directory = metrics_config.get('textfile_dir', '.')
+                path = os.path.join(directory, f"{self.prefix}_{job}.prom")
+                with open(f"{path}.tmp", 'w') as f:
+                    f.write(self.prometheus(job))
+                os.replace(f"{path}.tmp", path)  # node_exporter must never read a half-written file
+
+            elif exporter == 'mongo':
+                collection = db.get_db('metrics')
+                if collection is not None:
+                    collection.insert_one(self.document(job))
+
+        except Exception as e:
+            logger.warning(f"Could not export metrics: {e}")
+
+
+metrics = Metrics()
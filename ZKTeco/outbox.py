@@ -0,0 +1,259 @@
+import random
+import time
+import pymongo
+from datetime import datetime, timedelta
+from bio_config import outbox as outbox_config
+from db import db
+from logger import logger
+from metrics import metrics
+
+
+class Outbox:
+    """
+    A durable queue of decided ERP submissions, stored in MongoDB.
+
+    Payloads are written to the outbox before they are sent, so a slow or failing ERP
+    never loses a punch: failed sends are retried with exponential backoff until they
+    succeed or run out of attempts, at which point they are parked as 'dead'.
+    Every entry has an idempotency key, so the same punch is never queued twice.
+    """
+    def __init__(self, erp, send, max_attempts=8, backoff=30, max_backoff=3600, on_dead=None, max_failures=5, drain_budget=300):
+        """
+        Initialize the Outbox class.
+
+        :param erp: The name of the ERP the outbox belongs to (e.g. 'erpnext')
+        :param send: A function taking (kind, payload, attempts) that sends one payload to the ERP
+            and raises on failure. `attempts` is the number of earlier failed attempts.
+        :param max_attempts: The number of attempts before an entry is dead-lettered
+        :param backoff: The base delay between attempts, in seconds
+        :param max_backoff: The longest delay between attempts, in seconds
+        :param on_dead: An optional function taking (kind, payload), called when an entry is dead-lettered
+        :param max_failures: The number of consecutive failed sends after which drain() stops
+        :param drain_budget: The number of seconds drain() may spend sending
+        """
+        self.erp = erp
+        self.send = send
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.on_dead = on_dead
+        self.max_failures = max_failures
+        self.drain_budget = drain_budget
+
+    def collection(self):
+        return db.get_db('outbox')
+
+    def key(self, key):
+        return f"{self.erp}:{key}"
+
+    def enqueue(self, items: list) -> set | None:
+        """
+        Write payloads to the outbox. Payloads whose key is already queued are ignored.
+
+        :param items: A list of (kind, payload, key) tuples
+        :return: The keys that were newly queued, or None if the outbox could not be written
+        """
+        client = self.collection()
+        if client is None:
+            logger.error("Database connection failed. Cannot write to the outbox.")
+            return None
+
+        if not items:
+            return set()
+
+        now = datetime.now()
+        docs = [
+            {
+                "_id": self.key(key), "erp": self.erp, "kind": kind, "payload": payload,
+                "status": "pending", "attempts": 0, "next_attempt_at": now, "created_at": now, "last_error": None
+            }
+            for kind, payload, key in items
+        ]
+        try:
+            client.insert_many(docs, ordered=False)
+            return { key for _, _, key in items }
+
+        except pymongo.errors.BulkWriteError as e:
+            errors = (e.details or {}).get("writeErrors", [])
+            if any(err.get("code") != 11000 for err in errors):
+                logger.error(f"Error writing to the outbox: {[err.get('errmsg') for err in errors if err.get('code') != 11000]}")
+                return None
+
+            duplicates = { docs[err["index"]]["_id"] for err in errors }
+            return { key for _, _, key in items if self.key(key) not in duplicates }
+
+        except pymongo.errors.PyMongoError as e:
+            logger.error(f"Error writing to the outbox: {e}")
+            return None
+
+    def mark_sent(self, keys: list) -> int:
+        """
+        Mark entries as sent, e.g. after they were delivered through a bulk request.
+
+        :param keys: A list of idempotency keys
+        :return: The number of entries marked
+        """
+        client = self.collection()
+        if client is None or not keys:
+            return 0
+
+        try:
+            result = client.update_many(
+                { "_id": { "$in": [self.key(k) for k in keys] } },
+                { "$set": { "status": "sent", "sent_at": datetime.now() } }
+            )
+            return result.modified_count
+
+        except pymongo.errors.PyMongoError as e:
+            logger.error(f"Error updating the outbox: {e}")
+            return 0
+
+    def submit(self, kind: str, payload: dict, key: str):
+        """
+        Queue a payload and try to send it straight away.
+        If the send fails, the payload stays queued and is retried by drain().
+
+        :param kind: The kind of submission (e.g. 'checkin', 'clock_in')
+        :param payload: The payload to send
+        :param key: The idempotency key of the payload
+        :return: The response of the ERP, or None if the payload was queued for later
+        """
+        fresh = self.enqueue([(kind, payload, key)])
+        if fresh is None:
+            return self.send(kind, payload, 0)  # The outbox is unavailable, send without it
+
+        if key not in fresh:
+            logger.info(f"Submission {key} is already in the outbox.")
+            return None
+
+        entry = self.claim({ "_id": self.key(key) })
+        return self.attempt(entry)[1] if entry else None
+
+    def claim(self, filters: dict) -> dict | None:
+        """
+        Atomically take a due pending entry, so that concurrent senders never send it twice.
+
+        :param filters: Additional filters on the entry
+        :return: The claimed entry, or None if there is none or the database is unavailable
+        """
+        client = self.collection()
+        if client is None:
+            return None
+
+        now = datetime.now()
+        return client.find_one_and_update(
+            { **filters, "erp": self.erp, "status": "pending", "next_attempt_at": { "$lte": now } },
+            { "$set": { "status": "sending", "claimed_at": now } },
+            sort=[("next_attempt_at", 1)],
+            return_document=pymongo.ReturnDocument.AFTER
+        )
+
+    def attempt(self, entry: dict):
+        """
+        Send a claimed entry and record the outcome.
+
+        :param entry: The claimed entry
+        :return: A tuple (sent, response), the response is None if the send failed
+        """
+        client = self.collection()
+        try:
+            with metrics.time('submit', transport=self.erp):
+                response = self.send(entry["kind"], dict(entry["payload"]), entry["attempts"])
+            metrics.inc('submissions', transport=self.erp, outcome='sent')
+            client.update_one({ "_id": entry["_id"] }, { "$set": { "status": "sent", "sent_at": datetime.now() } })
+            return True, response
+
+        except Exception as e:
+            attempts = entry["attempts"] + 1
+            if attempts >= self.max_attempts:
+                client.update_one(
+                    { "_id": entry["_id"] },
+                    { "$set": { "status": "dead", "attempts": attempts, "last_error": str(e) } }
+                )
+                logger.error(f"Giving up on submission {entry['_id']} after {attempts} attempts: {e}")
+                metrics.inc('submissions', transport=self.erp, outcome='dead')
+                if self.on_dead:
+                    try:
+                        self.on_dead(entry["kind"], dict(entry["payload"]))
+                    except Exception as error:
+                        logger.error(f"Error handling dead submission {entry['_id']}: {error}")
+            else:
+                delay = min(self.max_backoff, self.backoff * 2 ** (attempts - 1))
+                delay = random.uniform(delay / 2, delay)
+                client.update_one(
+                    { "_id": entry["_id"] },
+                    { "$set": {
+                        "status": "pending", "attempts": attempts, "last_error": str(e),
+                        "next_attempt_at": datetime.now() + timedelta(seconds=delay)
+                    } }
+                )
+                logger.warning(f"Submission {entry['_id']} failed (attempt {attempts}), retrying in {round(delay)}s: {e}")
+                metrics.inc('submissions', transport=self.erp, outcome='retry')
+            return False, None
+
+    def drain(self, limit: int=None) -> dict:
+        """
+        Send every due entry of the outbox, oldest first. The drain stops early after
+        `max_failures` consecutive failed sends or once `drain_budget` seconds are spent,
+        so that an unavailable ERP does not block the run for timeout x entries.
+
+        :param limit: The maximum number of entries to send
+        :return: A dictionary with the number of `sent` and `failed` entries
+        """
+        client = self.collection()
+        if client is None:
+            logger.error("Database connection failed. Cannot drain the outbox.")
+            return { "sent": 0, "failed": 0 }
+
+        # Entries left in 'sending' by a process that died mid-send
+        client.update_many(
+            { "erp": self.erp, "status": "sending", "claimed_at": { "$lt": datetime.now() - timedelta(minutes=15) } },
+            { "$set": { "status": "pending" } }
+        )
+
+        sent = failed = streak = 0
+        expires = time.monotonic() + self.drain_budget if self.drain_budget else None
+        while limit is None or sent + failed < limit:
+            if self.max_failures and streak >= self.max_failures:
+                logger.warning(f"Stopping the outbox drain after {streak} consecutive failures, the ERP looks unavailable.")
+                break
+
+            if expires is not None and time.monotonic() > expires:
+                logger.warning(f"Stopping the outbox drain, it ran for more than {self.drain_budget}s.")
+                break
+
+            entry = self.claim({})
+            if entry is None:
+                break
+
+            if self.attempt(entry)[0]:
+                sent += 1
+                streak = 0
+            else:
+                failed += 1
+                streak += 1
+
+        if sent or failed:
+            logger.info(f"Outbox drained: {sent} sent, {failed} failed.")
+
+        return { "sent": sent, "failed": failed }
+
+
+def create_outbox(erp, send, on_dead=None):
+    """
+    Create the outbox of an ERP using the retry settings from bio_config.
+
+    :param erp: The name of the ERP
+    :param send: The outbox send function of the ERP transport
+    :param on_dead: An optional function taking (kind, payload), called when an entry is dead-lettered
+    :return: An Outbox instance
+    """
+    return Outbox(
+        erp, send,
+        max_attempts=outbox_config.get('max_attempts', 8),
+        backoff=outbox_config.get('backoff', 30),
+        max_backoff=outbox_config.get('max_backoff', 3600),
+        on_dead=on_dead,
+        max_failures=outbox_config.get('max_failures', 5),
+        drain_budget=outbox_config.get('drain_budget', 300)
+    )
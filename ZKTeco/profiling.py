@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+
+'''
+    Profiles runs of main.py and puller.py (started with --profile and/or --trace-memory)
+    and inspects the results.
+
+    Every profiled run is written to its own directory under profiling.directory
+    (cProfile stats in profile.pstats, the tracemalloc snapshot in memory.snapshot and
+    its top allocations in memory.txt); only the newest profiling.keep runs are kept.
+
+    Usage: profiling.py list
+           profiling.py summarize <run> [--top 25]
+           profiling.py diff <run> <other run> [--top 25]
+           profiling.py pack <run>
+
+    <run> is the name of a run (see list) or the path of its directory.
+'''
+
+import os
+import sys
+import io
+import shutil
+import pstats
+import cProfile
+import tracemalloc
+from datetime import datetime
+from bio_config import profiling
+from logger import logger
+
+
+class Profiler:
+    """
+    Collects the cProfile stats and/or the tracemalloc snapshot of one run.
+    """
+    def __init__(self, job, profile=False, trace_memory=False, directory='profiles', keep=10):
+        """
+        Initialize the Profiler class.
+
+        :param job: The name of the profiled process (e.g. 'main', 'puller')
+        :param profile: Collect cProfile stats
+        :param trace_memory: Collect a tracemalloc snapshot
+        :param directory: The directory the runs are written to
+        :param keep: The number of runs kept in the directory
+        """
+        self.job = job
+        self.profile = cProfile.Profile() if profile else None
+        self.trace_memory = trace_memory
+        self.directory = directory
+        self.keep = keep
+        self.started = None
+
+    def start(self):
+        self.started = datetime.now()
+        if self.trace_memory:
+            tracemalloc.start(25)
+        if self.profile:
+            self.profile.enable()
+        return self
+
+    def stop(self) -> str | None:
+        """
+        Stops profiling and writes the run to its directory.
+
+        :return: The directory of the run, or None if it could not be written
+        """
+        if self.started is None:
+            return None
+
+        if self.profile:
+            self.profile.disable()
+
+        run = os.path.join(self.directory, f"{self.job}-{self.started.strftime('%Y%m%d-%H%M%S')}")
+        try:
+            os.makedirs(run, exist_ok=True)
+            if self.profile:
+                self.profile.dump_stats(os.path.join(run, 'profile.pstats'))
+
+            if self.trace_memory:
+                snapshot = tracemalloc.take_snapshot()
+                _, peak = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+                snapshot.dump(os.path.join(run, 'memory.snapshot'))
+                with open(os.path.join(run, 'memory.txt'), 'w') as f:
+                    f.write(f"Peak traced memory: {peak / 1024 / 1024:.2f} MB\n\n")
+                    for stat in snapshot.statistics('lineno')[:50]:
+                        f.write(f"{stat}\n")
+
+            rotate(self.directory, self.keep)
+            logger.info(f"Profile of this run written to {run}")
+            return run
+
+        except OSError as e:
+            logger.warning(f"Could not write the profile of this run: {e}")
+            return None
+        finally:
+            self.started = None
+
+
+def from_argv(job):
+    """
+    Starts a Profiler if the command line asks for one (--profile and/or --trace-memory).
+
+    :param job: The name of the profiled process
+    :return: The started Profiler, or None
+    """
+    profile, trace_memory = '--profile' in sys.argv, '--trace-memory' in sys.argv
+    if not profile and not trace_memory:
+        return None
+
+    return Profiler(
+        job, profile, trace_memory,
+        directory=profiling.get('directory', 'profiles'),
+        keep=profiling.get('keep', 10)
+    ).start()
+
+
+def runs(directory) -> list:
+    """
+    Lists the profiled runs, oldest first.
+
+    :param directory: The directory of the runs
+    :return: A list of run directory names
+    """
+    if not os.path.isdir(directory):
+        return []
+
+    entries = [e for e in os.listdir(directory) if os.path.isdir(os.path.join(directory, e))]
+    return sorted(entries, key=lambda e: os.path.getmtime(os.path.join(directory, e)))
+
+
+def rotate(directory, keep):
+    """
+    Deletes the oldest runs, keeping the newest `keep` ones.
+    """
+    for run in runs(directory)[:-keep] if keep else []:
+        shutil.rmtree(os.path.join(directory, run), ignore_errors=True)
+
+
+def locate(run, directory) -> str:
+    path = run if os.path.isdir(run) else os.path.join(directory, run)
+    if not os.path.isdir(path):
+        raise FileNotFoundError(f"No profiled run named {run} in {directory}")
+    return path
+
+
+def label(key) -> str:
+    filename, line, func = key
+    return f"{func} ({os.path.basename(filename)}:{line})" if line else func
+
+
+def summarize(path, top=25) -> str:
+    """
+    Summarizes a run: the functions with the highest cumulative time and the biggest allocations.
+
+    :param path: The directory of the run
+    :param top: The number of entries shown
+    :return: The summary as text
+    """
+    out = io.StringIO()
+    stats_file = os.path.join(path, 'profile.pstats')
+    if os.path.exists(stats_file):
+        stats = pstats.Stats(stats_file, stream=out)
+        out.write(f"Total time: {stats.total_tt:.3f}s\n")
+        stats.sort_stats('cumulative').print_stats(top)
+
+    memory_file = os.path.join(path, 'memory.snapshot')
+    if os.path.exists(memory_file):
+        snapshot = tracemalloc.Snapshot.load(memory_file)
+        out.write(f"Top {top} allocations:\n")
+        for stat in snapshot.statistics('lineno')[:top]:
+            out.write(f"  {stat}\n")
+
+    return out.getvalue()
+
+
+def diff(path, other, top=25) -> str:
+    """
+    Compares two runs: the functions whose cumulative time changed the most and the
+    allocations that grew the most from the first run to the second.
+
+    :param path: The directory of the first run
+    :param other: The directory of the second run
+    :param top: The number of entries shown
+    :return: The comparison as text
+    """
+    out = io.StringIO()
+    before, after = os.path.join(path, 'profile.pstats'), os.path.join(other, 'profile.pstats')
+    if os.path.exists(before) and os.path.exists(after):
+        a, b = pstats.Stats(before).stats, pstats.Stats(after).stats
+        total_a, total_b = pstats.Stats(before).total_tt, pstats.Stats(after).total_tt
+        out.write(f"Total time: {total_a:.3f}s -> {total_b:.3f}s ({total_b - total_a:+.3f}s)\n")
+        out.write(f"{'cumulative before':>18}{'after':>10}{'delta':>10}{'calls':>10}  function\n")
+        deltas = [
+            (b.get(key, (0, 0, 0, 0))[3] - a.get(key, (0, 0, 0, 0))[3], key)
+            for key in set(a) | set(b)
+        ]
+        for delta, key in sorted(deltas, key=lambda d: abs(d[0]), reverse=True)[:top]:
+            ct_a, ct_b = a.get(key, (0, 0, 0, 0))[3], b.get(key, (0, 0, 0, 0))[3]
+            calls = b.get(key, (0, 0))[1] - a.get(key, (0, 0))[1]
+            out.write(f"{ct_a:>18.3f}{ct_b:>10.3f}{delta:>+10.3f}{calls:>+10}  {label(key)}\n")
+
+    before, after = os.path.join(path, 'memory.snapshot'), os.path.join(other, 'memory.snapshot')
+    if os.path.exists(before) and os.path.exists(after):
+        changes = tracemalloc.Snapshot.load(after).compare_to(tracemalloc.Snapshot.load(before), 'lineno')
+        out.write(f"\nTop {top} allocation changes:\n")
+        for stat in changes[:top]:
+            out.write(f"  {stat}\n")
+
+    return out.getvalue()
+
+
+def pack(path) -> str:
+    """
+    Packs a run into a .tar.gz archive in the current directory, to send it from a site.
+
+    :param path: The directory of the run
+    :return: The path of the archive
+    """
+    path = os.path.abspath(path)
+    return shutil.make_archive(os.path.basename(path), 'gztar', os.path.dirname(path), os.path.basename(path))
+
+
+if __name__ == '__main__':
+    directory = profiling.get('directory', 'profiles')
+    top = int(sys.argv[sys.argv.index('--top') + 1]) if '--top' in sys.argv else 25
+    args = [a for i, a in enumerate(sys.argv[1:], start=1) if not a.startswith('--') and sys.argv[i - 1] != '--top']
+    command = args[0] if args else None
+
+    try:
+        if command == 'list':
+            for run in runs(directory):
+                print(f"{run}\t{', '.join(sorted(os.listdir(os.path.join(directory, run))))}")
+
+        elif command == 'summarize' and len(args) > 1:
+            print(summarize(locate(args[1], directory), top))
+
+        elif command == 'diff' and len(args) > 2:
+            print(diff(locate(args[1], directory), locate(args[2], directory), top))
+
+        elif command == 'pack' and len(args) > 1:
+            print(pack(locate(args[1], directory)))
+
+        else:
+            print(__doc__)
+            exit(1)
+
+    except FileNotFoundError as e:
+        print(e)
+        exit(1)
@@ -1,46 +1,348 @@
 #!/usr/bin/env python3
 
-from exec import exec
-from bio_config import devices
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from exec import Session
+from bio_config import devices, puller
 from db import db
 from logger import logger
+from metrics import metrics
+import profiling
 
-if __name__ == "__main__":
-    for device in devices:
-        logger.info(f"Starting attendance puller for device: {device.get('name')}")
-        try:
-            client = db.get_db('records')
-            if client is None:
-                logger.error(f"Database connection failed. Skiping device {device.get('name')}.")
-                continue
-
-            exec(device, 'disable_device')
-            records = exec(device, 'get_attendance')
+
+stragglers = set()  # Workers of devices reported as timed out that are still running, see finish()
+
+
+class DeadlineExceeded(Exception):
+    """Exception raised when a device takes longer than its allowed deadline."""
+    def __init__(self, message="The device did not finish before its deadline."):
+        self.message = message
+        super().__init__(self.message)
+
+
+def check_deadline(device, expires):
+    """
+    Raises DeadlineExceeded if the device has run past its deadline.
+
+    :param device: The device configuration dictionary
+    :param expires: The time.monotonic() value at which the device expires
+    """
+    if expires is not None and time.monotonic() > expires:
+        raise DeadlineExceeded(f"Device {device.get('name')} exceeded its deadline.")
+
+
+def unread(records, watermark):
+    """
+    Returns the records of a device log that are newer than its watermark.
+
+    Device logs are append-only until they are cleared, so while the log is at least
+    as long as the watermark count and the last read record is still in place, the
+    new records are simply everything after it. Otherwise the log has been cleared
+    and the records are filtered by timestamp instead.
+
+    :param records: The attendance records read from the device
+    :param watermark: The watermark dictionary stored for the device, or None
+    :return: A list of the records that have not been stored yet
+    """
+    if not watermark:
+        return records
+
+    count, timestamp = watermark.get('count', 0), watermark.get('timestamp')
+    if 0 < count <= len(records) and records[count - 1].timestamp == timestamp:
+        return records[count:]
+
+    return [record for record in records if timestamp is None or record.timestamp > timestamp]
+
+
+def chunks(device, records, size):
+    """
+    Converts the attendance records of a device into database documents, `size` at a time,
+    so that a large log is never held twice in memory.
+
+    :param device: The device configuration dictionary
+    :param records: The attendance records read from the device
+    :param size: The number of records per chunk
+    :return: A generator of lists of record documents
+    """
+    for offset in range(0, len(records), size):
+        yield [
+            {"attendance_device_id": record.user_id, "timestamp": record.timestamp, "status": record.status, "punch": record.punch, "device": device.get('ip')}
+            for record in records[offset:offset + size]
+        ]
+
+
+def store(device, records):
+    """
+    Writes the attendance records of a device to the database chunk by chunk, logging the
+    progress of large logs and stopping at the first chunk that cannot be stored.
+    Chunks already written stay stored, rewriting them on the next pull is harmless.
+
+    :param device: The device configuration dictionary
+    :param records: The attendance records read from the device
+    :return: A dictionary with the `inserted` and `existing` counts, or None if a chunk could not be stored.
+    """
+    name, ip = device.get('name'), device.get('ip')
+    size = max(1, device.get('chunk_size', puller.get('chunk_size', 5000)))
+    stored = {"inserted": 0, "existing": 0}
+    for chunk in chunks(device, records, size):
+        with metrics.time('insert', device=ip):
+            re = db.upsert_records(chunk)
+        if re is None:
+            return None
+
+        metrics.inc('records_inserted', re["inserted"], device=ip)
+        metrics.inc('records_existing', re["existing"], device=ip)
+        stored["inserted"] += re["inserted"]
+        stored["existing"] += re["existing"]
+        if len(records) > size:
+            logger.info(f"Stored {stored['inserted'] + stored['existing']}/{len(records)} records from: ({name})")
+
+    return stored
+
+
+def pull_device(device, pool=None, incremental=False):
+    """
+    Pulls the attendance records of a single device into the database,
+    running every device operation over a single connection.
+
+    :param device: The device configuration dictionary
+    :param pool: An optional SessionPool that keeps the connection warm between runs
+    :param incremental: Only store records newer than the device watermark and do not clear the device
+    :return: A summary dictionary for the device
+    """
+    name = device.get('name')
+    deadline = device.get('deadline', puller.get('deadline'))
+    start = time.monotonic()
+    expires = start + deadline if deadline else None
+    summary = {"device": name, "ip": device.get('ip'), "status": "ok", "records": 0, "error": None}
+
+    logger.info(f"Starting attendance puller for device: {name}")
+    try:
+        with (pool.session(device) if pool else Session(device)) as session:
+            check_deadline(device, expires)
+            session.run('disable_device')
+            check_deadline(device, expires)
+            with metrics.time('download', device=device.get('ip')):
+                records = session.run('get_attendance')
+            metrics.inc('records_downloaded', len(records or []), device=device.get('ip'))
+            # The records are downloaded, storing them is never abandoned for the deadline
             if not records or len(records) < 1:
-                logger.warning(f"No attendance records found for device: {device['name']}")
-                continue
+                logger.warning(f"No attendance records found for device: {name}")
+                summary["status"] = "empty"
 
             elif isinstance(records, list):
-                records = [
-                    {"attendance_device_id": record.user_id, "timestamp": record.timestamp, "status": record.status, "punch": record.punch, "device": device.get('ip')}
-                    for record in records
-                ]
-                re = client.insert_many(records)
-                if re.acknowledged:
-                    logger.success(f"Inserted {len(re.inserted_ids)} records into the database from: ({device['name']})")
-                    exec(device, 'clear_attendance')
+                total, latest = len(records), records[-1].timestamp
+                if incremental:
+                    records = unread(records, db.get_watermark(device.get('ip')))
+
+                if not records:
+                    logger.info(f"No new attendance records on device: {name}")
+                    summary["status"] = "empty"
+                    if incremental:
+                        db.set_watermark(device.get('ip'), latest, total)
 
                 else:
-                    logger.error(f"Failed to insert records into the database for device: {device['name']}")
-                    logger.error(f"Possible reason: {re}")
-                    logger.error("Please solve the issue and try again.")
+                    re = store(device, records)
+                    if re is not None:
+                        summary["records"] = re["inserted"]
+                        logger.success(f"Inserted {re['inserted']} new records ({re['existing']} already stored) into the database from: ({name})")
+                        if incremental:
+                            db.set_watermark(device.get('ip'), latest, total)
+                        else:
+                            session.run('clear_attendance')
+
+                    else:
+                        summary["status"] = "failed"
+                        summary["error"] = "Records could not be stored"
+                        logger.error(f"Failed to insert records into the database for device: {name}")
+                        logger.error("Please solve the issue and try again.")
+
+            session.run('enable_device')
+
+    except DeadlineExceeded as de:
+        summary["status"] = "timeout"
+        summary["error"] = str(de)
+        logger.error(f"Deadline exceeded while processing device {name}: {de}")
+
+    except ConnectionError as ce:
+        summary["status"] = "failed"
+        summary["error"] = str(ce)
+        logger.error(f"Connection error while processing device {name}: {ce}")
+
+    except Exception as e:
+        summary["status"] = "failed"
+        summary["error"] = str(e)
+        logger.error(f"Error while processing device {name}: {e}")
 
-        except ConnectionError as ce:
-            logger.error(f"Connection error while processing device {device['name']}: {ce}")
+    summary["elapsed"] = round(time.monotonic() - start, 2)
+    metrics.inc('pulls', device=device.get('ip'), status=summary["status"])
+    metrics.observe('pull', summary["elapsed"], device=device.get('ip'))
+    return summary
+
+
+def clear_device(device, pool=None):
+    """
+    Clears the attendance log of a device, but only if its watermark shows that
+    every record on it has already been stored.
+
+    :param device: The device configuration dictionary
+    :param pool: An optional SessionPool that keeps the connection warm between runs
+    :return: True if the device was cleared, False otherwise
+    """
+    name = device.get('name')
+    try:
+        with (pool.session(device) if pool else Session(device)) as session:
+            session.run('disable_device')
+            records = session.run('get_attendance') or []
+            if records and unread(records, db.get_watermark(device.get('ip'))):
+                logger.warning(f"Device {name} holds records that have not been stored yet. Not clearing it.")
+                return False
+
+            if records:
+                session.run('clear_attendance')
+                watermark = db.get_watermark(device.get('ip')) or {}
+                db.set_watermark(device.get('ip'), watermark.get('timestamp'), 0)
+                logger.success(f"Cleared {len(records)} records from device: {name}")
+
+            session.run('enable_device')
+            return True
+
+    except Exception as e:
+        logger.error(f"Error while clearing device {name}: {e}")
+        return False
+
+
+def pull_all(devices, workers=1, pool=None, incremental=False):
+    """
+    Pulls the attendance records of all devices, running up to `workers` devices at the same time.
+
+    Every device is given its deadline from the moment a worker starts it. A device still running
+    past its deadline (e.g. blocked on an unresponsive socket) is reported as timed out without
+    waiting for it; its worker finishes in the background and whatever it downloads is still stored,
+    as long as the database connection stays open (see finish()).
+
+    :param devices: A list of device configuration dictionaries
+    :param workers: The maximum number of devices pulled concurrently
+    :param pool: An optional SessionPool shared across runs in long-running mode
+    :param incremental: Use the device watermarks instead of clearing the devices
+    :return: A list of per-device summary dictionaries, in the order of `devices`
+    """
+    if db.get_db('records') is None:
+        logger.error("Database connection failed. Skipping all devices.")
+        return [
+            {"device": d.get('name'), "ip": d.get('ip'), "status": "failed", "records": 0, "error": "Database connection failed", "elapsed": 0}
+            for d in devices
+        ]
+
+    started = {}
+
+    def run(n, device):
+        started[n] = time.monotonic()
+        return pull_device(device, pool, incremental)
+
+    executor = ThreadPoolExecutor(max_workers=max(1, min(workers, len(devices) or 1)))
+    futures = { executor.submit(run, n, device): n for n, device in enumerate(devices) }
+    summaries = [None] * len(devices)
+    pending = set(futures)
+    try:
+        while pending:
+            done, pending = wait(pending, timeout=0.5, return_when=FIRST_COMPLETED)
+            for future in done:
+                summaries[futures[future]] = future.result()
+
+            for future in list(pending):
+                n = futures[future]
+                device = devices[n]
+                deadline = device.get('deadline', puller.get('deadline'))
+                if deadline and n in started and time.monotonic() - started[n] > deadline:
+                    pending.discard(future)
+                    stragglers.add(future)
+                    error = f"Device {device.get('name')} exceeded its deadline."
+                    logger.error(f"Deadline exceeded while processing device {device.get('name')}: {error}")
+                    summaries[n] = {"device": device.get('name'), "ip": device.get('ip'), "status": "timeout", "records": 0, "error": error, "elapsed": round(time.monotonic() - started[n], 2)}
+                    metrics.inc('pulls', device=device.get('ip'), status="timeout")
+
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    return summaries
+
+
+def finish(timeout=None) -> int:
+    """
+    Waits for the workers of the devices that pull_all reported as timed out, so that the
+    records they are still downloading or storing are not lost by closing the database.
+
+    :param timeout: The number of seconds to wait, None waits until they are all done
+    :return: The number of workers still running
+    """
+    if not stragglers:
+        return 0
+
+    logger.info(f"Waiting up to {timeout}s for {len(stragglers)} devices past their deadline to finish...")
+    done, running = wait(list(stragglers), timeout=timeout)
+    for future in done:
+        stragglers.discard(future)
+        s = future.result()
+        logger.info(f"{s['device']} ({s['ip']}) finished after its deadline: {s['status']}, {s['records']} records in {s['elapsed']}s")
+
+    return len(running)
+
+
+def polled(devices):
+    """
+    Returns the devices that have to be polled, leaving out the ones that push their attendance.
+
+    :param devices: A list of device configuration dictionaries
+    :return: The list of polled devices
+    """
+    return [device for device in devices if not device.get('push')]
+
+
+def report(summaries, elapsed):
+    """
+    Logs a per-device summary of a pull run.
+
+    :param summaries: The summaries returned by pull_all
+    :param elapsed: The total wall time of the run in seconds
+    """
+    for s in summaries:
+        line = f"{s['device']} ({s['ip']}): {s['status']}, {s['records']} records in {s['elapsed']}s"
+        if s['status'] in ('ok', 'empty'):
+            logger.info(line)
+        else:
+            logger.error(f"{line} - {s['error']}")
+
+    failed = sum(1 for s in summaries if s['status'] not in ('ok', 'empty'))
+    total = sum(s['records'] for s in summaries)
+    logger.info(f"Pulled {total} records from {len(summaries) - failed}/{len(summaries)} devices in {round(elapsed, 2)}s")
+
+
+if __name__ == "__main__":
+    workers = puller.get('workers', 1)
+    if '-w' in sys.argv or '--workers' in sys.argv:
+        workers_index = sys.argv.index('-w') if '-w' in sys.argv else sys.argv.index('--workers')
+        workers = int(sys.argv[workers_index + 1])
 
-        except Exception as e:
-            logger.error(f"Error while processing device {device['name']}: {e}")
+    if '--clear' in sys.argv:
+        for device in polled(devices):
+            clear_device(device)
+        db.close_connection()
+        exit(0)
 
-        exec(device, 'enable_device')
+    incremental = puller.get('incremental', False) or '--incremental' in sys.argv
+    profiler = profiling.from_argv('puller')
+    start = time.monotonic()
+    try:
+        summaries = pull_all(polled(devices), workers, incremental=incremental)
+    finally:
+        if profiler:
+            profiler.stop()
+    report(summaries, time.monotonic() - start)
+    running = finish(puller.get('grace', 30))
+    if running:
+        logger.warning(f"{running} devices are still running, they are left uncleared and pulled again on the next run.")
+    metrics.export('puller')
     db.close_connection()
     logger.success("All devices processed. Main script will run next.")
@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Copyright (c) 2024-2025 Buffer Punk Ltd. and contributors. All rights reserved.
+
+'''
+    Runs the device puller and the ERP sync as a single long-running service.
+    The database, HTTP and device connections are opened once and kept warm
+    between cycles, and the backlog after a downtime is caught up automatically.
+
+    Usage: service.py -m <module_name> [--verbose]
+'''
+
+import sys
+import signal
+import threading
+import time
+from datetime import datetime
+from bio_config import devices, importer, live, puller, service
+from db import db
+from exec import SessionPool
+from http_client import http_client
+from logger import logger
+from metrics import metrics
+from main import load_module, load_employees, import_attendance
+from puller import pull_all, polled, report
+from live import start_all, stop_all
+
+
+class Service:
+    """
+    Schedules the pull and sync cycles of one ERP until it is asked to stop.
+    """
+    def __init__(self, module, pull_interval=600, sync_interval=600, catchup_after=1200, bulk=True, live=False):
+        """
+        Initialize the Service class.
+
+        :param module: The ERP transport package
+        :param pull_interval: The number of seconds between two pulls of the devices
+        :param sync_interval: The number of seconds between two syncs with the ERP
+        :param catchup_after: The number of seconds without a successful sync after which the backlog is caught up
+        :param bulk: Use the bulk endpoint of the ERP for regular syncs
+        :param live: Capture the punches of the devices as they happen and sync them right away,
+            instead of pulling the devices on an interval
+        """
+        self.module = module
+        self.pull_interval = pull_interval
+        self.sync_interval = sync_interval
+        self.catchup_after = catchup_after
+        self.bulk = bulk
+        self.live = live
+        self.pool = SessionPool()
+        self.stopping = threading.Event()
+        self.punched = threading.Event()
+        self.wake = threading.Event()
+
+    def stop(self, signum=None, frame=None):
+        """
+        Asks the service to stop once the current step is done. Used as the SIGTERM/SIGINT handler.
+        """
+        if not self.stopping.is_set():
+            logger.info('Stop requested. Finishing the current step...')
+        self.stopping.set()
+        self.wake.set()
+
+    def punch(self):
+        """
+        Asks for a sync as soon as possible. Called by the live captures when punches arrive.
+        """
+        self.punched.set()
+        self.wake.set()
+
+    def pull(self):
+        """
+        Pulls the attendance records of every device over the pooled connections.
+        """
+        start = time.monotonic()
+        summaries = pull_all(polled(devices), puller.get('workers', 1), pool=self.pool, incremental=puller.get('incremental', False))
+        report(summaries, time.monotonic() - start)
+
+    def last_sync(self) -> datetime | None:
+        """
+        Get the time of the last successful sync, kept in the database so that it survives restarts.
+
+        :return: The time of the last successful sync, or None if there was none
+        """
+        state = db.get_db('service')
+        return (state.find_one({ "_id": self.module.__name__ }) or {}).get('synced_at') if state is not None else None
+
+    def sync(self):
+        """
+        Sends the undelivered records to the ERP. After a long enough gap since the
+        last successful sync, the backlog is streamed in batches through the bulk endpoint.
+        """
+        started = datetime.now()
+        transport = self.module.transport
+        if hasattr(transport, 'reset'):
+            transport.reset()
+
+        ids = load_employees(self.module)
+        transport.outbox.drain()
+
+        last = self.last_sync()
+        if last is None or (started - last).total_seconds() > self.catchup_after:
+            self.catch_up(ids, last)
+        else:
+            import_attendance(self.module, ids, bulk=self.bulk)
+
+        transport.outbox.drain()
+        db.get_db('service').update_one({ "_id": self.module.__name__ }, { "$set": { "synced_at": started } }, upsert=True)
+
+    def catch_up(self, ids, last=None):
+        """
+        Streams the undelivered records to the ERP in batches through the bulk endpoint.
+
+        :param ids: The attendance device IDs of the employees
+        :param last: The time of the last successful sync, for logging
+        """
+        logger.info(f'Last successful sync: {last or "never"}. Catching up on undelivered records...')
+        filters = { "delivered": False, "attendance_device_id": { "$in": ids } }
+        state = {}  # Per-employee last state, carried from one batch to the next
+        for batch in db.stream_filtered_records(filters=filters, batch_size=importer.get('batch_size', 500)):
+            import_attendance(self.module, ids, records=batch, state=state, bulk=True)
+            if self.stopping.is_set():
+                logger.warning('Catch-up interrupted, it will resume on the next start.')
+                raise InterruptedError('Catch-up interrupted by a stop request.')
+
+    def step(self, name, func):
+        """
+        Runs one step of a cycle, logging its errors instead of stopping the service.
+
+        :param name: The name of the step, for logging
+        :param func: The function running the step
+        """
+        try:
+            func()
+        except InterruptedError:
+            pass
+        except Exception as e:
+            logger.error(f'{name.capitalize()} failed: {e}')
+        finally:
+            metrics.export('service')
+
+    def run(self):
+        """
+        Runs the pull and sync cycles on their intervals until stop() is called.
+        """
+        captures = []
+        if self.live:
+            # A device serves one connection at a time, so the captures do their own batch pulls
+            logger.info(f'Service started: capturing punches live, syncing every {self.sync_interval}s')
+            captures = start_all(polled(devices), on_punch=self.punch)
+        else:
+            logger.info(f'Service started: pulling every {self.pull_interval}s, syncing every {self.sync_interval}s')
+
+        next_pull = float('inf') if self.live else time.monotonic()
+        next_sync = time.monotonic()
+        while not self.stopping.is_set():
+            if time.monotonic() >= next_pull:
+                self.step('pull', self.pull)
+                next_pull = time.monotonic() + self.pull_interval
+
+            if self.punched.is_set():
+                self.punched.clear()
+                next_sync = time.monotonic()
+
+            if not self.stopping.is_set() and time.monotonic() >= next_sync:
+                self.step('sync', self.sync)
+                next_sync = time.monotonic() + self.sync_interval
+
+            self.wake.wait(max(0, min(next_pull, next_sync) - time.monotonic()))
+            self.wake.clear()
+
+        stop_all(captures)
+        self.close()
+
+    def close(self):
+        """
+        Closes every connection held by the service.
+        """
+        self.pool.close_all()
+        token_manager = getattr(getattr(self.module, 'utils', None), 'token_manager', None)
+        if token_manager:
+            token_manager.stop()
+
+        db.close_connection()
+        http_client.close()
+        logger.info('Service stopped.')
+
+
+if __name__ == '__main__':
+    if '-m' not in sys.argv and '--module' not in sys.argv:
+        print(f"Usage: {sys.argv[0]} -m <module_name> [--verbose]")
+        exit(1)
+
+    try:
+        module_index = sys.argv.index('-m') if '-m' in sys.argv else sys.argv.index('--module')
+        module = load_module(sys.argv[module_index + 1])
+
+    except (IndexError, ValueError, ImportError) as e:
+        logger.error(f"Error loading module: {e}")
+        exit(1)
+
+    if not devices:
+        logger.error('Please fill in the necessary details in bio_config.py before running the service')
+        exit(1)
+
+    runner = Service(
+        module,
+        pull_interval=service.get('pull_interval', 600),
+        sync_interval=service.get('sync_interval', 600),
+        catchup_after=service.get('catchup_after', 1200),
+        bulk=service.get('bulk', True),
+        live=live.get('enabled', False),
+    )
+    signal.signal(signal.SIGTERM, runner.stop)
+    signal.signal(signal.SIGINT, runner.stop)
+    runner.run()
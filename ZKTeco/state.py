@@ -0,0 +1,154 @@
+import pymongo
+from datetime import datetime, timedelta
+from bio_config import state as state_config
+from db import db
+from logger import logger
+
+
+class StateStore:
+    """
+    The last check-in state of each employee (time, log type and where it came from),
+    kept in MongoDB so that decisions do not have to ask the ERP for the previous punch.
+    It is updated whenever a submission succeeds and reconciled against the ERP on a schedule.
+    """
+    def __init__(self, erp, fetch, interval=3600):
+        """
+        Initialize the StateStore class.
+
+        :param erp: The name of the ERP the state belongs to (e.g. 'erpnext')
+        :param fetch: A function returning the state of the employees in the ERP, as a list
+            of dictionaries with the `employee`, `time` (datetime) and `log_type` keys
+        :param interval: The number of seconds between reconciliations with the ERP
+        """
+        self.erp = erp
+        self.fetch = fetch
+        self.interval = interval
+        self.cache = {}
+
+    def collection(self):
+        return db.get_db('checkin_state')
+
+    def get(self, employee) -> dict | None:
+        """
+        Get the last check-in state of an employee.
+
+        :param employee: The employee identifier
+        :return: A dictionary with the `time`, `log_type` and `source` keys, or None if unknown
+        """
+        return self.get_many([employee]).get(employee)
+
+    def get_many(self, employees: list) -> dict:
+        """
+        Get the last check-in state of several employees with a single query.
+
+        :param employees: A list of employee identifiers
+        :return: A dictionary of employee -> state, without the unknown employees
+        """
+        missing = [e for e in set(employees) if e is not None and e not in self.cache]
+        client = self.collection()
+        if missing and client is not None:
+            try:
+                for doc in client.find({ "erp": self.erp, "employee": { "$in": missing } }, { "_id": 0 }):
+                    self.cache[doc["employee"]] = doc
+            except pymongo.errors.PyMongoError as e:
+                logger.error(f"Error fetching check-in state: {e}")
+
+        return { e: self.cache[e] for e in employees if e in self.cache }
+
+    def record(self, employee, time: datetime, log_type: str, source: str='local', force: bool=False) -> bool:
+        """
+        Atomically store a new check-in state, unless a newer one is already stored.
+
+        :param employee: The employee identifier
+        :param time: The time of the check-in
+        :param log_type: 'IN', 'OUT' or None
+        :param source: Where the state comes from ('local' for our own submissions, 'erp' for reconciliation)
+        :param force: Store the state even if a newer one is stored
+        :return: True if the state was stored
+        """
+        if employee is None or time is None:
+            return False
+
+        client = self.collection()
+        if client is None:
+            return False
+
+        doc = { "time": time, "log_type": log_type, "source": source, "updated_at": datetime.now() }
+        filters = { "erp": self.erp, "employee": employee }
+        if not force:
+            filters["$or"] = [{ "time": { "$lte": time } }, { "time": { "$exists": False } }]
+
+        try:
+            client.update_one(filters, { "$set": doc }, upsert=True)
+            self.cache[employee] = { "erp": self.erp, "employee": employee, **doc }
+            return True
+
+        except pymongo.errors.DuplicateKeyError:
+            self.cache.pop(employee, None)  # A newer state is already stored, reload it on the next read
+            return False
+
+        except pymongo.errors.PyMongoError as e:
+            logger.error(f"Error storing check-in state for {employee}: {e}")
+            return False
+
+    def forget(self, employee) -> bool:
+        """
+        Delete the stored state of an employee, e.g. when a submission it was built from was
+        never delivered. The next decision then asks the ERP for the previous punch again.
+
+        :param employee: The employee identifier
+        :return: True if the state was deleted
+        """
+        self.cache.pop(employee, None)
+        client = self.collection()
+        if employee is None or client is None:
+            return False
+
+        try:
+            return client.delete_one({ "erp": self.erp, "employee": employee }).deleted_count > 0
+
+        except pymongo.errors.PyMongoError as e:
+            logger.error(f"Error deleting check-in state for {employee}: {e}")
+            return False
+
+    def reconcile(self, force: bool=False) -> int:
+        """
+        Reconcile the stored states with the ERP if the reconciliation interval has passed.
+        The newer of the stored and the ERP state wins, the ERP wins ties.
+
+        :param force: Reconcile even if the interval has not passed
+        :return: The number of states updated from the ERP
+        """
+        meta = db.get_db('state_meta')
+        if meta is None:
+            return 0
+
+        last = (meta.find_one({ "_id": self.erp }) or {}).get('reconciled_at')
+        if not force and last and datetime.now() - last < timedelta(seconds=self.interval):
+            return 0
+
+        try:
+            remote = self.fetch()
+        except Exception as e:
+            logger.warning(f"Could not reconcile check-in state with the ERP: {e}")
+            return 0
+
+        updated = 0
+        for entry in remote:
+            if self.record(entry["employee"], entry["time"], entry.get("log_type"), source='erp'):
+                updated += 1
+
+        meta.update_one({ "_id": self.erp }, { "$set": { "reconciled_at": datetime.now() } }, upsert=True)
+        logger.info(f"Check-in state reconciled with the ERP: {updated} of {len(remote)} employees updated.")
+        return updated
+
+
+def create_state(erp, fetch):
+    """
+    Create the check-in state store of an ERP using the interval from bio_config.
+
+    :param erp: The name of the ERP
+    :param fetch: The state fetch function of the ERP transport
+    :return: A StateStore instance
+    """
+    return StateStore(erp, fetch, interval=state_config.get('reconcile_interval', 3600))
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+
+'''
+    Benchmarks the pull stage (puller.py) against simulated devices.
+
+    Starts the virtual devices of zk_sim.py, pulls them into a dedicated database with
+    puller.pull_all like puller.py does, and reports the wall time, the peak memory and
+    the Mongo write throughput of the run.
+
+    Usage: pull.py [--devices 10] [--punches 5000] [--workers 8] [--latency 0] [--loss 0]
+                   [--dead 0] [--timeout 5] [--runs 1] [--incremental] [--db attendance_bench]
+                   [--json results.json]
+'''
+
+import os
+import sys
+import json
+import time
+import threading
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'ZKTeco'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import zk_sim
+from db import db
+
+
+def option(name, default, cast=str):
+    return cast(sys.argv[sys.argv.index(name) + 1]) if name in sys.argv else default
+
+
+class WriteTimer:
+    """
+    Wraps db.upsert_records to measure the time spent writing to Mongo.
+    """
+    def __init__(self):
+        self.write = db.upsert_records
+        self.lock = threading.Lock()
+        self.seconds = 0.0
+        self.records = 0
+
+    def __call__(self, records):
+        start = time.perf_counter()
+        result = self.write(records)
+        with self.lock:
+            self.seconds += time.perf_counter() - start
+            self.records += len(records)
+        return result
+
+
+def run(started: list, devices: list, workers: int, incremental: bool) -> dict:
+    """
+    Runs one pull of every virtual device.
+
+    :param started: The virtual devices returned by zk_sim.start()
+    :param devices: Their device configuration dictionaries
+    :param workers: The number of devices pulled at the same time
+    :param incremental: Use the watermarks instead of clearing the devices
+    :return: The results of the run
+    """
+    from puller import pull_all, report, finish
+
+    timer = WriteTimer()
+    db.upsert_records = timer
+    tracemalloc.start()
+    start = time.perf_counter()
+    summaries = pull_all(devices, workers, incremental=incremental)
+    elapsed = time.perf_counter() - start
+    finish()  # The devices past their deadline still store their records
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    db.upsert_records = timer.write
+    report(summaries, elapsed)
+
+    inserted = sum(s['records'] for s in summaries)
+    return {
+        "devices": len(devices),
+        "workers": workers,
+        "elapsed": round(elapsed, 3),
+        "inserted": inserted,
+        "records_per_sec": round(inserted / elapsed, 1) if elapsed else None,
+        "write_seconds": round(timer.seconds, 3),
+        "writes_per_sec": round(timer.records / timer.seconds, 1) if timer.seconds else None,
+        "peak_memory_mb": round(peak / 1024 / 1024, 2),
+        "statuses": { status: sum(1 for s in summaries if s['status'] == status) for status in { s['status'] for s in summaries } },
+        "commands": sum(device.commands for device, _ in started),
+    }
+
+
+if __name__ == '__main__':
+    db.name = option('--db', 'attendance_bench')
+    if db.name == 'attendance':
+        print("Refusing to run the benchmark on the production database.")
+        exit(1)
+
+    punches = option('--punches', 5000, int)
+    started = zk_sim.start(
+        devices=option('--devices', 10, int),
+        punches=punches,
+        latency=option('--latency', 0, float) / 1000,
+        loss=option('--loss', 0, float),
+        dead=option('--dead', 0, int),
+    )
+    devices = zk_sim.configs(started, timeout=option('--timeout', 5, int))
+    workers = option('--workers', 8, int)
+    incremental = '--incremental' in sys.argv
+
+    db.get_db('records')
+    db.client.drop_database(db.name)
+    db.ensure_indexes()
+
+    results = []
+    for n in range(option('--runs', 1, int)):
+        if n and not incremental:
+            for device, _ in started:
+                device.fill(punches)  # The previous run cleared the devices
+        results.append(run(started, devices, workers, incremental))
+
+    zk_sim.stop(started)
+    db.client.drop_database(db.name)
+
+    print(f"{'run':<5}{'elapsed':>9}{'inserted':>10}{'rec/s':>10}{'write/s':>10}{'peak MB':>9}  statuses")
+    for n, r in enumerate(results, start=1):
+        print(f"{n:<5}{r['elapsed']:>9}{r['inserted']:>10}{str(r['records_per_sec']):>10}{str(r['writes_per_sec']):>10}{r['peak_memory_mb']:>9}  {r['statuses']}")
+
+    if '--json' in sys.argv:
+        with open(option('--json', None), 'w') as f:
+            json.dump(results, f, indent=2)
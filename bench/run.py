@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+
+'''
+    Benchmarks the ERP sync of main.py against the stub ERP server.
+
+    For every transport and mode, a dedicated database is seeded with synthetic
+    undelivered records, the records are sent to the stub ERP exactly like main.py
+    does, and the throughput, the requests per record and the peak memory are reported.
+    Results can be saved and compared with an earlier run to catch regressions.
+
+    Usage: run.py [--erp erpnext,laravel] [--mode record,bulk,async] [--records 2000]
+                  [--employees 100] [--latency 5] [--error-rate 0] [--db attendance_bench]
+                  [--json results.json] [--compare baseline.json] [--tolerance 0.1]
+'''
+
+import os
+import sys
+import json
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'ZKTeco'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import stub_erp
+from db import db
+
+
+modes = {
+    "record": { "bulk": False, "use_async": False },
+    "bulk": { "bulk": True, "use_async": False },
+    "async": { "bulk": False, "use_async": True },
+}
+
+
+def option(name, default, cast=str):
+    return cast(sys.argv[sys.argv.index(name) + 1]) if name in sys.argv else default
+
+
+def seed(records: int, employees: int):
+    """
+    Recreates the benchmark database with synthetic undelivered records.
+    Every employee punches about every 4 hours, so the records span several days.
+
+    :param records: The number of records
+    :param employees: The number of employees punching
+    """
+    db.get_db('records')
+    db.client.drop_database(db.name)
+    db.ensure_indexes()
+
+    start = datetime.now().replace(hour=6, minute=0, second=0, microsecond=0) - timedelta(days=records // (employees * 6) + 1)
+    db.get_db('records').insert_many([
+        {
+            "attendance_device_id": stub_erp.device_id(i % employees + 1),
+            "timestamp": start + timedelta(hours=4 * (i // employees), seconds=i % employees),
+            "status": 1, "punch": 0, "device": "10.0.0.1", "delivered": False
+        }
+        for i in range(records)
+    ])
+
+
+def prepare(erp: str, url: str):
+    """
+    Loads a transport, points it to the stub ERP and clears its in-memory state.
+
+    :param erp: The name of the ERP
+    :param url: The URL of the stub ERP
+    :return: The transport package
+    """
+    import main
+    module = main.load_module(erp)
+    module.transport.api_url = url
+    if hasattr(module, 'utils'):
+        module.utils.api_url = url
+        module.utils.token_manager.stop()
+        module.utils.token_manager.token = None
+
+    module.transport.reset()
+    module.transport.directory.entries = None
+    return module
+
+
+def run(erp: str, mode: str, server, records: int, employees: int) -> dict:
+    """
+    Runs one benchmark scenario.
+
+    :param erp: The name of the ERP
+    :param mode: The sync mode, one of `modes`
+    :param server: The stub ERP server
+    :param records: The number of records
+    :param employees: The number of employees punching
+    :return: The results of the scenario
+    """
+    import main
+    seed(records, employees)
+    server.stub.reset()
+    module = prepare(erp, server.url)
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    ids = main.load_employees(module)
+    main.import_attendance(module, ids, **modes[mode])
+    module.transport.outbox.drain()
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    requests = dict(server.stub.requests)
+    return {
+        "erp": erp,
+        "mode": mode,
+        "records": records,
+        "employees": employees,
+        "elapsed": round(elapsed, 3),
+        "records_per_sec": round(records / elapsed, 1) if elapsed else None,
+        "requests": sum(requests.values()),
+        "requests_per_record": round(sum(requests.values()) / records, 3),
+        "peak_memory_mb": round(peak / 1024 / 1024, 2),
+        "undelivered": db.get_db('records').count_documents({ "delivered": False }),
+        "queued": db.get_db('outbox').count_documents({ "status": { "$ne": "sent" } }),
+        "errors": server.stub.errors,
+        "by_route": requests,
+    }
+
+
+def report(results: list, baseline: list=None, tolerance: float=0.1) -> bool:
+    """
+    Prints the results, compared with a baseline if there is one.
+
+    :param results: The results of the scenarios
+    :param baseline: The results of an earlier run
+    :param tolerance: The drop in records/sec (or rise in requests/record) tolerated before a scenario counts as a regression
+    :return: True if no scenario regressed
+    """
+    previous = { (r["erp"], r["mode"]): r for r in baseline or [] }
+    ok = True
+    print(f"{'erp':<9}{'mode':<7}{'records':>8}{'rec/s':>10}{'req/rec':>9}{'peak MB':>9}{'undeliv.':>9}{'queued':>8}  vs baseline")
+    for r in results:
+        line = f"{r['erp']:<9}{r['mode']:<7}{r['records']:>8}{r['records_per_sec']:>10}{r['requests_per_record']:>9}{r['peak_memory_mb']:>9}{r['undelivered']:>9}{r['queued']:>8}"
+        before = previous.get((r["erp"], r["mode"]))
+        if before:
+            speed = r["records_per_sec"] / before["records_per_sec"] - 1
+            calls = r["requests_per_record"] - before["requests_per_record"]
+            regressed = speed < -tolerance or calls > before["requests_per_record"] * tolerance
+            ok = ok and not regressed
+            line += f"  {speed:+.1%} rec/s, {calls:+.3f} req/rec{'  REGRESSION' if regressed else ''}"
+        print(line)
+
+    return ok
+
+
+if __name__ == '__main__':
+    db.name = option('--db', 'attendance_bench')
+    if db.name == 'attendance':
+        print("Refusing to run the benchmark on the production database.")
+        exit(1)
+
+    erps = option('--erp', 'erpnext,laravel').split(',')
+    selected = option('--mode', 'record,bulk,async').split(',')
+    records = option('--records', 2000, int)
+    employees = option('--employees', 100, int)
+
+    server = stub_erp.start(
+        employees=employees,
+        latency=option('--latency', 5, float) / 1000,
+        error_rate=option('--error-rate', 0, float),
+    )
+    results = [run(erp, mode, server, records, employees) for erp in erps for mode in selected]
+    server.shutdown()
+
+    if '--json' in sys.argv:
+        with open(option('--json', None), 'w') as f:
+            json.dump(results, f, indent=2)
+
+    baseline = None
+    if '--compare' in sys.argv:
+        with open(option('--compare', None)) as f:
+            baseline = json.load(f)
+
+    ok = report(results, baseline, option('--tolerance', 0.1, float))
+    db.client.drop_database(db.name)
+    exit(0 if ok else 1)
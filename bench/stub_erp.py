@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+
+'''
+    A stub ERP server for the benchmarks. It emulates the Frappe endpoints used by the
+    erpnext transport and the connector endpoints used by the laravel transport, keeps
+    the submitted check-ins in memory and counts the requests it receives.
+    Every response can be delayed and a share of them can fail, to emulate a slow or flaky ERP.
+
+    Usage: stub_erp.py [--port 8090] [--employees 100] [--latency 20] [--error-rate 0.01]
+'''
+
+import json
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs, unquote
+
+
+def parse_time(value) -> datetime:
+    value = str(value).split('.')[0].replace('T', ' ')
+    return datetime.strptime(value, '%Y-%m-%d %H:%M:%S')
+
+
+def format_time(value: datetime) -> str:
+    return value.strftime('%Y-%m-%d %H:%M:%S')
+
+
+def device_id(n: int) -> str:
+    return str(1000 + n)
+
+
+class StubERP:
+    """
+    The in-memory state of the stub ERP: its employees, their check-ins (Frappe)
+    and their attendances (connector), and the request counters.
+    """
+    def __init__(self, employees=100, latency=0.0, error_rate=0.0):
+        """
+        Initialize the StubERP class.
+
+        :param employees: The number of employees
+        :param latency: The number of seconds every response is delayed by
+        :param error_rate: The share of requests answered with a 503 (between 0 and 1)
+        """
+        self.employees = employees
+        self.latency = latency
+        self.error_rate = error_rate
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """
+        Forgets every submission and resets the counters.
+        """
+        with self.lock:
+            self.checkins = {}  # employee -> list of (time, log_type)
+            self.attendances = {}  # user_id -> list of {clock_in_time, clock_out_time}
+            self.requests = Counter()
+            self.errors = 0
+
+    # Frappe
+
+    def frappe_employees(self):
+        return [
+            {
+                "employee": f"HR-EMP-{n:05d}", "employee_name": f"Employee {n}", "attendance_device_id": device_id(n),
+                "status": "Active", "modified": "2024-01-01 00:00:00"
+            }
+            for n in range(1, self.employees + 1)
+        ]
+
+    def frappe_checkins(self, query: dict):
+        filters = json.loads((query.get('filters') or ['[]'])[0])
+        fields = json.loads((query.get('fields') or ['[]'])[0])
+        employees, times = None, None
+        for field, op, value in filters:
+            if field == 'employee':
+                employees = set(value) if op == 'in' else { value }
+            elif field == 'time':
+                times = { parse_time(v) for v in (value if op == 'in' else [value]) }
+
+        with self.lock:
+            rows = [
+                (employee, t, log_type)
+                for employee, logs in self.checkins.items() if employees is None or employee in employees
+                for t, log_type in logs if times is None or t in times
+            ]
+
+        if "max(time) as time" in fields:  # The grouped query of get_all_checkins
+            latest = {}
+            for employee, t, _ in rows:
+                latest[employee] = max(t, latest.get(employee, t))
+            data = [{ "employee": e, "time": format_time(latest[e]) } for e in sorted(latest)]
+            start = int((query.get('limit_start') or [0])[0])
+            length = int((query.get('limit_page_length') or [0])[0])
+            return data[start:start + length] if length else data[start:]
+
+        return [
+            { "name": f"CHK-{employee}-{format_time(t)}", "employee": employee, "time": format_time(t), "log_type": log_type }
+            for employee, t, log_type in rows
+        ]
+
+    def frappe_insert(self, docs: list):
+        with self.lock:
+            for doc in docs:
+                self.checkins.setdefault(doc['employee'], []).append((parse_time(doc['time']), doc.get('log_type')))
+
+        return [f"CHK-{doc['employee']}-{doc['time']}" for doc in docs]
+
+    # Connector
+
+    def connector_users(self):
+        return [
+            { "id": n, "first_name": "Employee", "last_name": str(n), "user_id": int(device_id(n)) }
+            for n in range(1, self.employees + 1)
+        ]
+
+    def connector_attendance(self, uid):
+        with self.lock:
+            rows = self.attendances.get(int(uid))
+            return dict(rows[-1], id=len(rows)) if rows else []
+
+    def connector_day(self, date: str):
+        with self.lock:
+            return [
+                { "user_id": uid, **rows[-1] }
+                for uid, rows in self.attendances.items()
+                if rows and str(rows[-1].get('clock_in_time') or rows[-1].get('clock_out_time')).startswith(date)
+            ]
+
+    def connector_clock(self, data: dict) -> str | None:
+        """
+        Applies a clock-in or clock-out.
+
+        :return: None on success, the error message otherwise
+        """
+        uid = int(data.get('user_id'))
+        with self.lock:
+            rows = self.attendances.setdefault(uid, [])
+            if data.get('clock_out_time'):
+                if not rows or rows[-1].get('clock_out_time'):
+                    return "Not clocked in"
+                rows[-1]['clock_out_time'] = format_time(parse_time(data['clock_out_time']))
+
+            else:
+                if rows and not rows[-1].get('clock_out_time'):
+                    return "Already clocked in"
+                rows.append({ "clock_in_time": format_time(parse_time(data['clock_in_time'])), "clock_out_time": None })
+
+        return None
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """
+    Routes the requests of the transports to the StubERP of the server.
+    """
+    protocol_version = "HTTP/1.1"  # Keep-alive, like the ERPs behind a real web server
+
+    def reply(self, code: int, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def body(self):
+        raw = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        if self.headers.get('Content-Type', '').startswith('application/json'):
+            return json.loads(raw or b'{}')
+        return { k: v[0] for k, v in parse_qs(raw.decode()).items() }
+
+    def handle_request(self, method: str):
+        stub: StubERP = self.server.stub
+        url = urlparse(self.path)
+        path, query = unquote(url.path), parse_qs(url.query)
+        route = path.rsplit('/', 1)[0] if path.startswith('/connector/api/get-attendance/') else path
+        data = self.body() if method == 'POST' else None
+
+        with stub.lock:
+            stub.requests[f"{method} {route}"] += 1
+
+        if stub.latency:
+            time.sleep(stub.latency)
+
+        if stub.error_rate and random.random() < stub.error_rate:
+            with stub.lock:
+                stub.errors += 1
+            return self.reply(503, { "message": "Service unavailable" })
+
+        if method == 'GET' and path == '/api/resource/Employee':
+            return self.reply(200, { "data": stub.frappe_employees() })
+        if method == 'GET' and path == '/api/resource/Employee Checkin':
+            return self.reply(200, { "data": stub.frappe_checkins(query) })
+        if method == 'POST' and path == '/api/resource/Employee Checkin':
+            return self.reply(200, { "data": { "name": stub.frappe_insert([data])[0] } })
+        if method == 'POST' and path == '/api/method/frappe.client.insert_many':
+            return self.reply(200, { "message": stub.frappe_insert(data.get('docs', [])) })
+
+        if method == 'POST' and path == '/oauth/token':
+            return self.reply(200, { "access_token": "stub", "refresh_token": "stub", "expires_in": 86400, "token_type": "Bearer" })
+        if method == 'GET' and path == '/connector/api/user':
+            return self.reply(200, { "data": stub.connector_users() })
+        if method == 'GET' and route == '/connector/api/get-attendance':
+            return self.reply(200, { "data": stub.connector_attendance(path.rsplit('/', 1)[1]) })
+        if method == 'GET' and path == '/connector/api/get-all-attendance':
+            return self.reply(200, { "data": stub.connector_day((query.get('date') or [''])[0]) })
+        if method == 'POST' and path in ('/connector/api/clock-in', '/connector/api/clock-out'):
+            error = stub.connector_clock(data)
+            return self.reply(400, { "message": error }) if error else self.reply(200, { "success": True })
+        if method == 'POST' and path == '/connector/api/bulk-send-attendance':
+            for item in data.get('bulk_data', []):
+                stub.connector_clock(item)
+            return self.reply(200, { "success": True })
+
+        return self.reply(404, { "message": f"No stub for {method} {path}" })
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start(port=0, employees=100, latency=0.0, error_rate=0.0):
+    """
+    Starts the stub ERP in a background thread.
+
+    :param port: The port to listen on (0 picks a free one)
+    :param employees: The number of employees
+    :param latency: The number of seconds every response is delayed by
+    :param error_rate: The share of requests answered with a 503
+    :return: The server, its StubERP is `server.stub` and its URL `server.url`
+    """
+    server = ThreadingHTTPServer(('127.0.0.1', port), StubHandler)
+    server.daemon_threads = True
+    server.stub = StubERP(employees, latency, error_rate)
+    server.url = f"http://127.0.0.1:{server.server_address[1]}"
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == '__main__':
+    def option(name, default, cast):
+        return cast(sys.argv[sys.argv.index(name) + 1]) if name in sys.argv else default
+
+    server = start(
+        port=option('--port', 8090, int),
+        employees=option('--employees', 100, int),
+        latency=option('--latency', 0, float) / 1000,
+        error_rate=option('--error-rate', 0, float),
+    )
+    print(f"Stub ERP listening on {server.url}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
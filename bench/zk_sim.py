@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+
+'''
+    A simulator of ZKTeco devices for load testing the puller. It speaks enough of the
+    ZK TCP protocol for pyzk's connect, disable_device, get_attendance, clear_attendance,
+    enable_device and disconnect to work against it.
+
+    Every virtual device listens on its own loopback address (127.0.0.10, 127.0.0.11, ...)
+    on port 4370 and holds a configurable number of punches. Replies can be delayed or
+    dropped, and dead devices accept connections but never answer.
+    Only TCP is simulated, so the devices have to be used without force_udp.
+
+    Usage: zk_sim.py [--devices 10] [--punches 5000] [--latency 5] [--loss 0] [--dead 0]
+'''
+
+import random
+import socketserver
+import sys
+import threading
+import time
+from datetime import datetime, timedelta
+from struct import pack, unpack
+
+CMD_CONNECT = 1000
+CMD_EXIT = 1001
+CMD_ENABLEDEVICE = 1002
+CMD_DISABLEDEVICE = 1003
+CMD_GET_FREE_SIZES = 50
+CMD_ATTLOG_RRQ = 13
+CMD_CLEAR_ATTLOG = 15
+CMD_PREPARE_BUFFER = 1503
+CMD_DATA = 1501
+CMD_ACK_OK = 2000
+CMD_ACK_ERROR = 2001
+
+MACHINE_PREPARE_DATA_1 = 0x5050
+MACHINE_PREPARE_DATA_2 = 0x7D82
+USHRT_MAX = 65535
+
+
+def checksum(packet: bytes) -> int:
+    """
+    The checksum of a ZK packet, computed like pyzk does.
+    """
+    total = 0
+    for i in range(0, len(packet) - 1, 2):
+        total += packet[i] | packet[i + 1] << 8
+        if total > USHRT_MAX:
+            total -= USHRT_MAX
+    if len(packet) % 2:
+        total += packet[-1]
+    while total > USHRT_MAX:
+        total -= USHRT_MAX
+    total = ~total
+    while total < 0:
+        total += USHRT_MAX
+    return total
+
+
+def encode_time(t: datetime) -> bytes:
+    """
+    Encodes a time like the devices do, the inverse of pyzk's __decode_time.
+    """
+    value = ((t.year % 100) * 12 * 31 + (t.month - 1) * 31 + t.day - 1) * 86400 + (t.hour * 60 + t.minute) * 60 + t.second
+    return pack('<I', value)
+
+
+class VirtualDevice:
+    """
+    The state of one simulated device and the faults injected into its replies.
+    """
+    def __init__(self, ip, port=4370, punches=1000, users=100, latency=0.0, loss=0.0, dead=False):
+        """
+        Initialize the VirtualDevice class.
+
+        :param ip: The loopback address the device listens on
+        :param port: The port the device listens on
+        :param punches: The number of punches the device holds
+        :param users: The number of users the punches are spread over
+        :param latency: The number of seconds every reply is delayed by
+        :param loss: The share of replies that are never sent (between 0 and 1)
+        :param dead: Accept connections but never answer
+        """
+        self.ip = ip
+        self.port = port
+        self.users = users
+        self.latency = latency
+        self.loss = loss
+        self.dead = dead
+        self.lock = threading.Lock()
+        self.commands = 0
+        self.fill(punches)
+
+    def fill(self, punches: int):
+        """
+        Replaces the attendance log of the device with `punches` synthetic punches, oldest first.
+        """
+        start = datetime.now().replace(microsecond=0) - timedelta(minutes=punches)
+        with self.lock:
+            self.log = [
+                (i % self.users + 1, str(1000 + i % self.users + 1), start + timedelta(minutes=i), i % 2)
+                for i in range(punches)
+            ]
+
+    def attendance_buffer(self) -> bytes:
+        """
+        The attendance log in the 40-byte record format of pyzk, prefixed with its size.
+        """
+        with self.lock:
+            data = b''.join(
+                pack('<H24sB4sB8s', uid, user_id.encode(), 1, encode_time(timestamp), punch, b'')
+                for uid, user_id, timestamp, punch in self.log
+            )
+        return pack('<I', len(data)) + data
+
+    def free_sizes(self) -> bytes:
+        fields = [0] * 20
+        fields[8] = len(self.log)  # Records, users are reported as 0 so pyzk does not ask for them
+        fields[16] = 100000  # Record capacity
+        return pack('<20i', *fields)
+
+    def handle(self, command: int, data: bytes) -> tuple:
+        """
+        Runs a command on the device.
+
+        :return: A tuple (reply command, reply data)
+        """
+        if command in (CMD_CONNECT, CMD_EXIT, CMD_ENABLEDEVICE, CMD_DISABLEDEVICE):
+            return CMD_ACK_OK, b''
+
+        if command == CMD_GET_FREE_SIZES:
+            return CMD_ACK_OK, self.free_sizes()
+
+        if command == CMD_PREPARE_BUFFER:
+            requested = unpack('<bhii', data[:11])[1] if len(data) >= 11 else None
+            if requested == CMD_ATTLOG_RRQ:
+                return CMD_DATA, self.attendance_buffer()
+            return CMD_ACK_ERROR, b''
+
+        if command == CMD_CLEAR_ATTLOG:
+            with self.lock:
+                self.log = []
+            return CMD_ACK_OK, b''
+
+        return CMD_ACK_OK, b''  # Commands the puller does not use are acknowledged
+
+
+class DeviceHandler(socketserver.BaseRequestHandler):
+    """
+    Serves one connection to a virtual device.
+    """
+    def read(self, size: int) -> bytes | None:
+        data = b''
+        while len(data) < size:
+            chunk = self.request.recv(size - len(data))
+            if not chunk:
+                return None
+            data += chunk
+        return data
+
+    def handle(self):
+        device: VirtualDevice = self.server.device
+        session_id = random.randint(1, USHRT_MAX - 1)
+        while True:
+            top = self.read(8)
+            if top is None:
+                return
+
+            magic1, magic2, length = unpack('<HHI', top)
+            packet = self.read(length)
+            if packet is None or magic1 != MACHINE_PREPARE_DATA_1 or magic2 != MACHINE_PREPARE_DATA_2:
+                return
+
+            command, _, _, reply_id = unpack('<4H', packet[:8])
+            with device.lock:
+                device.commands += 1
+
+            if device.dead:
+                continue
+
+            reply, data = device.handle(command, packet[8:])
+            if device.latency:
+                time.sleep(device.latency)
+
+            if device.loss and random.random() < device.loss:
+                continue
+
+            header = pack('<4H', reply, 0, session_id, reply_id) + data
+            header = pack('<4H', reply, checksum(header), session_id, reply_id) + data
+            self.request.sendall(pack('<HHI', MACHINE_PREPARE_DATA_1, MACHINE_PREPARE_DATA_2, len(header)) + header)
+            if command == CMD_EXIT:
+                return
+
+
+class DeviceServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def start(devices: int=10, punches: int=1000, latency: float=0.0, loss: float=0.0, dead: int=0, port: int=4370) -> list:
+    """
+    Starts the virtual devices in background threads.
+
+    :param devices: The number of devices
+    :param punches: The number of punches each device holds
+    :param latency: The number of seconds every reply is delayed by
+    :param loss: The share of replies that are dropped
+    :param dead: The number of devices that never answer (the last ones)
+    :param port: The port every device listens on
+    :return: A list of (VirtualDevice, server) tuples
+    """
+    started = []
+    for n in range(devices):
+        device = VirtualDevice(f"127.0.0.{10 + n}", port, punches, latency=latency, loss=loss, dead=n >= devices - dead)
+        server = DeviceServer((device.ip, port), DeviceHandler)
+        server.device = device
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        started.append((device, server))
+
+    return started
+
+
+def configs(started: list, timeout: int=5) -> list:
+    """
+    Builds the bio_config device entries of the virtual devices.
+
+    :param started: The list returned by start()
+    :param timeout: The pyzk timeout of the devices
+    :return: A list of device configuration dictionaries
+    """
+    return [
+        { "name": f"Virtual {device.ip}", "ip": device.ip, "port": device.port, "timeout": timeout, "ommit_ping": True }
+        for device, _ in started
+    ]
+
+
+def stop(started: list):
+    for _, server in started:
+        server.shutdown()
+        server.server_close()
+
+
+if __name__ == '__main__':
+    def option(name, default, cast):
+        return cast(sys.argv[sys.argv.index(name) + 1]) if name in sys.argv else default
+
+    started = start(
+        devices=option('--devices', 10, int),
+        punches=option('--punches', 1000, int),
+        latency=option('--latency', 0, float) / 1000,
+        loss=option('--loss', 0, float),
+        dead=option('--dead', 0, int),
+        port=option('--port', 4370, int),
+    )
+    for device, _ in started:
+        print(f"{device.ip}:{device.port} {'dead' if device.dead else f'{len(device.log)} punches'}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        stop(started)